@@ -14,6 +14,7 @@ import discord.ext.commands as commands
 import utils.checks as checks
 from utils.log import get_logger
 from utils.messaging import Paginate, notify_owner
+from utils.sendqueue import get_send_scheduler
 
 
 def setup(bot):
@@ -123,10 +124,17 @@ class Control(commands.Cog, name='Core'):
     def get_health(self):
         'Returns a string describing the status of this cog'
         if self.bot.is_logged_in:
-            return '\n  \u2714 Logged in as {}, id: {}'.format(
+            response = '\n  \u2714 Logged in as {}, id: {}'.format(
                 self.bot.user.name, self.bot.user.id)
-
-        return '\n  \u2716 Bot is not currently logged in'
+        else:
+            response = '\n  \u2716 Bot is not currently logged in'
+
+        stats = get_send_scheduler(self.bot.loop).get_stats()
+        for name, class_stats in stats.items():
+            response += ('\n  \u2714 Send queue {}: {sent} sent, {queued} '
+                         'queued, waited p50 {p50:.2f}s, p95 {p95:.2f}s, '
+                         'max {max:.2f}s').format(name, **class_stats)
+        return response
 
     @commands.command()
     @commands.check(checks.is_owner)
@@ -1,3 +1,4 @@
 from utils import extension
 
-extension.configure(["listener", "poster"])
+extension.configure(["listener", "killstream", "poster", "backfill",
+                     "stats"])
@@ -0,0 +1,321 @@
+'''
+Killmail backfill cog for antinub-gregbot project.
+
+Pages through zKillboard's history of a corporation or alliance, fetches
+the killmail bodies from ESI with bounded concurrency and either posts them
+at the lowest send priority or archives them in the recording format.
+Progress is checkpointed after every page so an interrupted backfill
+resumes where it stopped.
+'''
+import asyncio
+import json
+import os
+import time
+import typing
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import aiohttp
+import discord.ext.commands as commands
+
+import utils.checks as checks
+from utils.esicog import EsiCog
+from utils.log import get_logger
+
+from .dedup import KillmailDeduplicator
+from .models import Package
+from .recording import PackageRecorder
+
+ZKILLBOARD_API_URL = 'https://zkillboard.com/api/{}ID/{:d}/page/{:d}/'
+BACKFILL_PATH = 'cache/backfill'
+CONCURRENCY = 4
+PAGE_RETRIES = 3
+PAGE_RETRY_WAIT = 10
+# Fetched without esi_cached_request, a backfill reads each killmail once
+KILLMAIL_OPERATION = 'get_killmails_killmail_id_killmail_hash'
+ENTITY_TYPES = ('corporation', 'alliance')
+MODES = ('post', 'archive')
+
+
+def setup(bot: commands.Bot):
+    bot.add_cog(KillmailBackfill(bot))
+
+
+class BackfillJob:
+    '''Backfill of one entity's killmails between start and end
+
+    zKillboard returns history newest first, so the job stops after the
+    first page reaching past `start`. The checkpoint holds the next page and
+    the oldest kill ID done; kills at or above it are skipped on resume, as
+    new kills push older ones onto later pages.'''
+
+    def __init__(self, cog: 'KillmailBackfill', entity_type: str,
+                 entity_id: int, start: datetime, end: datetime, mode: str,
+                 path: str = BACKFILL_PATH):
+        self.logger = get_logger(__name__)
+        self.cog = cog
+        self.entity_type = entity_type
+        self.entity_id = entity_id
+        self.start = start
+        self.end = end
+        self.mode = mode
+        self.path = Path(path)
+        self.checkpoint_path = self.path / '{}-{:d}.json'.format(
+            entity_type, entity_id)
+
+        self.page = 1
+        self.oldest_kill_id: int = None
+        self.processed = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.finished = False
+        self._recorder: PackageRecorder = None
+        self._semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    @property
+    def description(self) -> str:
+        return '{} {:d} from {:%Y-%m-%d} to {:%Y-%m-%d} ({})'.format(
+            self.entity_type, self.entity_id, self.start, self.end,
+            self.mode)
+
+    @property
+    def throughput(self) -> float:
+        'Killmails processed per second since the job started'
+        return self.processed / max(time.monotonic() - self.started_at, 1e-9)
+
+    @property
+    def archive_path(self) -> Path:
+        return self.path / '{}-{:d}.jsonl.gz'.format(self.entity_type,
+                                                     self.entity_id)
+
+    def status(self) -> str:
+        return ('{}: page {:d}, {:d} killmails ({:.1f}/s), {:d} duplicates, '
+                '{:d} failed').format(self.description, self.page,
+                                      self.processed, self.throughput,
+                                      self.duplicates, self.failed)
+
+    def load_checkpoint(self) -> bool:
+        'Resume from the checkpoint of the same backfill, if there is one'
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return False
+
+        if (checkpoint['start'], checkpoint['end'], checkpoint['mode']) != \
+                (self.start.isoformat(), self.end.isoformat(), self.mode):
+            return False
+        self.page = checkpoint['page']
+        self.oldest_kill_id = checkpoint['oldest_kill_id']
+        return True
+
+    def save_checkpoint(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.checkpoint_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'start': self.start.isoformat(),
+                       'end': self.end.isoformat(), 'mode': self.mode,
+                       'page': self.page,
+                       'oldest_kill_id': self.oldest_kill_id}, f)
+        os.replace(str(tmp_path), str(self.checkpoint_path))
+
+    async def run(self):
+        if self.mode == 'archive':
+            self._recorder = PackageRecorder(str(self.archive_path))
+        try:
+            while True:
+                entries = await self.fetch_page()
+                if not entries:
+                    break
+                if self.oldest_kill_id is not None:
+                    entries = [entry for entry in entries
+                               if entry['killmail_id'] < self.oldest_kill_id]
+
+                results = await asyncio.gather(*map(self.process, entries))
+                if entries:
+                    self.oldest_kill_id = min(
+                        entry['killmail_id'] for entry in entries)
+                self.page += 1
+                self.save_checkpoint()
+                if any(killmail_time is not None
+                       and killmail_time < self.start
+                       for killmail_time in results):
+                    break
+        finally:
+            if self._recorder is not None:
+                self._recorder.close()
+
+        self.finished = True
+        if self.checkpoint_path.exists():
+            os.remove(str(self.checkpoint_path))
+
+    async def fetch_page(self) -> typing.List[dict]:
+        url = ZKILLBOARD_API_URL.format(self.entity_type, self.entity_id,
+                                        self.page)
+        for attempt in range(PAGE_RETRIES):
+            try:
+                async with self.cog.bot.http.session.get(url) as resp:
+                    resp.raise_for_status()
+                    return await resp.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == PAGE_RETRIES - 1:
+                    raise
+                self.logger.warning('Failed to fetch %s, retrying', url)
+                await asyncio.sleep(PAGE_RETRY_WAIT)
+
+    async def process(self, entry: dict) -> typing.Optional[datetime]:
+        '''Fetch, filter and handle one killmail, returning its time or None
+        if it could not be fetched'''
+        async with self._semaphore:
+            kill_id = entry['killmail_id']
+            try:
+                killmail = await self.cog.fetch_killmail(
+                    kill_id, entry['zkb']['hash'])
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception('Failed to fetch killmail %d', kill_id)
+                self.failed += 1
+                return None
+
+            killmail_time = datetime.strptime(killmail['killmail_time'],
+                                              '%Y-%m-%dT%H:%M:%SZ')
+            if not self.start <= killmail_time <= self.end:
+                return killmail_time
+
+            contents = {'killID': kill_id, 'killmail': killmail,
+                        'zkb': entry['zkb']}
+            if self._recorder is not None:
+                self._recorder.record(
+                    json.dumps({'package': contents}).encode())
+            else:
+                await self.post(Package.from_dict(contents))
+            self.processed += 1
+            return killmail_time
+
+    async def post(self, package: Package):
+        '''Post a killmail unless the listener has already seen it, live or
+        from an earlier backfill'''
+        poster = self.cog.bot.get_cog('KillmailPoster')
+        if poster is None:
+            raise RuntimeError('KillmailPoster is not loaded')
+        deduplicator = self.cog.deduplicator
+        if deduplicator is not None \
+                and not deduplicator.check(package.kill_id):
+            self.duplicates += 1
+            return
+        try:
+            await poster.on_killmail(package, backfill=True)
+        except Exception:  # pylint: disable=broad-except
+            self.failed += 1
+            await self.cog.bot.on_error(
+                'killmail', debug_info='backfill of {:d}'.format(
+                    package.kill_id))
+
+
+class KillmailBackfill(EsiCog, commands.Cog, name='Backfill'):
+    def __init__(self, bot: commands.Bot):
+        super(KillmailBackfill, self).__init__(bot)
+        self.logger = get_logger(__name__)
+        self.bot = bot
+        config = (bot.ext_config or {}).get('killmails', {})
+        self.path = config.get('backfill_path', BACKFILL_PATH)
+        self.job: BackfillJob = None
+        self.task: asyncio.Task = None
+
+    def cog_unload(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.bot.loop.create_task(self.close_esi_session())
+
+    @property
+    def deduplicator(self) -> typing.Optional[KillmailDeduplicator]:
+        'The deduplicator of the loaded killmail listener, if any'
+        for name in ('RedisQListener', 'KillstreamListener'):
+            listener = self.bot.get_cog(name)
+            if listener is not None:
+                return listener.deduplicator
+        return None
+
+    def get_health(self):
+        'Returns a string describing the status of this cog'
+        if self.task is not None and not self.task.done():
+            return '\n  \u2714 Backfilling ' + self.job.status()
+        return '\n  \u2714 Idle'
+
+    async def fetch_killmail(self, kill_id: int, killmail_hash: str) -> dict:
+        esi_app = await self.get_esi_app()
+        response = await self.esi_request(
+            esi_app.op[KILLMAIL_OPERATION](
+                killmail_id=kill_id, killmail_hash=killmail_hash))
+        if response.status != 200:
+            raise ValueError('ESI returned {} for killmail {:d}'.format(
+                response.status, kill_id))
+        return json.loads(response.raw)
+
+    @commands.group(invoke_without_command=True)
+    @commands.check(checks.is_owner)
+    async def backfill(self, ctx, entity_type: str, entity_id: int,
+                       start: str, end: str = None, mode: str = 'post'):
+        '''Backfill killmails of a corporation or alliance between two dates
+        (YYYY-MM-DD), posting or archiving them'''
+        if entity_type not in ENTITY_TYPES or mode not in MODES:
+            await ctx.send('Usage: {}backfill [corporation | alliance] <id> '
+                           '<start> [end] [post | archive]'.format(
+                               ctx.prefix))
+            return
+        if self.task is not None and not self.task.done():
+            await ctx.send('Already backfilling ' + self.job.description)
+            return
+
+        try:
+            start_time = datetime.strptime(start, '%Y-%m-%d')
+            # The end date is inclusive
+            end_time = datetime.strptime(end, '%Y-%m-%d') \
+                + timedelta(days=1, seconds=-1) if end else datetime.utcnow()
+        except ValueError:
+            await ctx.send('Dates must be given as YYYY-MM-DD')
+            return
+
+        self.job = BackfillJob(self, entity_type, entity_id, start_time,
+                               end_time, mode, self.path)
+        if self.job.load_checkpoint():
+            await ctx.send('Resuming backfill of {} from page {:d}'.format(
+                self.job.description, self.job.page))
+        else:
+            await ctx.send('Backfilling ' + self.job.description)
+        self.task = self.bot.loop.create_task(self.run(ctx, self.job))
+
+    @backfill.command(name='status')
+    async def backfill_status(self, ctx):
+        'Show the progress of the running backfill'
+        if self.job is None:
+            await ctx.send('No backfill has run')
+            return
+        state = 'Finished' if self.job.finished else 'Running'
+        if self.task.done() and not self.job.finished:
+            state = 'Stopped'
+        await ctx.send('{}: {}'.format(state, self.job.status()))
+
+    @backfill.command(name='cancel')
+    async def backfill_cancel(self, ctx):
+        'Stop the running backfill, keeping its checkpoint'
+        if self.task is None or self.task.done():
+            await ctx.send('No backfill is running')
+            return
+        self.task.cancel()
+        await ctx.send('Cancelled at page {:d}, run it again to resume'
+                       .format(self.job.page))
+
+    async def run(self, ctx, job: BackfillJob):
+        try:
+            await job.run()
+        except Exception as exception:
+            self.logger.exception('Backfill of %s failed', job.description)
+            await ctx.send('Backfill failed at page {:d}: `{}`'.format(
+                job.page, exception))
+            return
+
+        response = 'Backfill finished: ' + job.status()
+        if job.mode == 'archive':
+            response += ', archived to `{}`'.format(job.archive_path)
+        await ctx.send(response)
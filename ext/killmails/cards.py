@@ -0,0 +1,328 @@
+'''
+Rendered killmail card images.
+
+A card shows the victim's fit, the top attackers and the ISK breakdown of a
+kill. Cards are drawn with Pillow in a process pool so rendering never
+blocks the event loop. Type icons are cached on disk, and the most recently
+used rendered cards are stored under the hash of their contents, so a card
+reposted to another channel or replayed after a restart is not drawn again.
+'''
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+import typing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import aiohttp
+
+from utils.log import get_logger
+from utils.sendqueue import percentile
+
+from .models import Attacker, Killmail, Package
+
+CARD_PATH = 'cache/cards'
+ICON_PATH = 'cache/icons'
+ICON_URL = 'https://imageserver.eveonline.com/Type/{:d}_64.png'
+# Bump when the layout changes so cached cards are redrawn
+CARD_VERSION = 1
+WORKERS = 2
+TIMING_SAMPLES = 1000
+CACHE_SIZE = 1000
+
+# Slot name -> inventory flags, in drawing order
+SLOT_FLAGS = (
+    ('High', range(27, 35)),
+    ('Mid', range(19, 27)),
+    ('Low', range(11, 19)),
+    ('Rig', range(92, 95)),
+    ('Subsystem', range(125, 133)),
+)
+MAX_ATTACKERS = 5
+
+WIDTH = 640
+ICON_SIZE = 32
+MARGIN = 12
+LINE_HEIGHT = 16
+BACKGROUND = (24, 24, 24)
+FOREGROUND = (220, 220, 220)
+MUTED = (140, 140, 140)
+
+
+def top_attackers(killmail: Killmail) -> typing.List[Attacker]:
+    return sorted(killmail.attackers, key=lambda attacker:
+                  attacker.damage_done or 0, reverse=True)[:MAX_ATTACKERS]
+
+
+def get_card_spec(package: Package, title: str, subtitle: str,
+                  names: typing.Dict[int, str],
+                  colour: typing.Tuple[int, int, int]) -> dict:
+    '''Collect what a card shows into plain data. names must cover the
+    characters, or corporations for NPCs, of the top attackers.'''
+    killmail = package.killmail
+
+    # A loaded charge shares its module's flag, keep the smallest stack
+    fitted = {}
+    for item in killmail.victim.items:
+        quantity = (item.quantity_destroyed or 0) + \
+            (item.quantity_dropped or 0)
+        if item.flag not in fitted or quantity < fitted[item.flag][0]:
+            fitted[item.flag] = (quantity, item.item_type_id)
+    slots = [(name, [fitted[flag][1] for flag in flags if flag in fitted])
+             for name, flags in SLOT_FLAGS]
+
+    attackers = []
+    for attacker in top_attackers(killmail):
+        entity_id = attacker.character_id or attacker.corporation_id
+        attackers.append({
+            'name': names.get(entity_id) or str(entity_id),
+            'ship_type_id': attacker.ship_type_id,
+            'damage': attacker.damage_done or 0,
+            'final_blow': bool(attacker.final_blow),
+        })
+
+    total = package.zkb.total_value or 0
+    fitted_value = package.zkb.fitted_value or 0
+    return {
+        'title': title,
+        'subtitle': subtitle,
+        'time': killmail.killmail_time.replace('T', ' ').rstrip('Z'),
+        'colour': list(colour),
+        'ship_type_id': killmail.victim.ship_type_id,
+        'slots': slots,
+        'attackers': attackers,
+        'attacker_count': len(killmail.attackers),
+        'values': [('Ship and fit', fitted_value),
+                   ('Cargo and drones', max(total - fitted_value, 0)),
+                   ('Total', total)],
+    }
+
+
+def render_card(spec: dict,
+                icons: typing.Dict[int, str]) -> typing.Tuple[bytes, float]:
+    '''Draw a card, returning the PNG and the seconds spent rendering.
+
+    Runs in a worker process, so it only takes and returns plain data.'''
+    from PIL import Image, ImageDraw, ImageFont
+
+    started = time.perf_counter()
+    font = ImageFont.load_default()
+    slot_rows = [(name, type_ids) for name, type_ids in spec['slots']
+                 if type_ids]
+    height = (MARGIN * 5 + 64
+              + len(slot_rows) * (ICON_SIZE + 4)
+              + LINE_HEIGHT + len(spec['attackers']) * (ICON_SIZE + 4)
+              + LINE_HEIGHT * len(spec['values']))
+    image = Image.new('RGB', (WIDTH, height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 4, height), fill=tuple(spec['colour']))
+
+    resized = {}
+
+    def paste_icon(type_id: int, position: tuple, size: int):
+        if type_id not in icons:
+            draw.rectangle(position + (position[0] + size,
+                                       position[1] + size), outline=MUTED)
+            return
+        icon = resized.get((type_id, size))
+        if icon is None:
+            with Image.open(icons[type_id]) as original:
+                icon = resized[type_id, size] = \
+                    original.convert('RGBA').resize((size, size))
+        image.paste(icon, position, icon)
+
+    # Header: victim ship, title and location
+    x, y = MARGIN * 2, MARGIN
+    paste_icon(spec['ship_type_id'], (x, y), 64)
+    draw.text((x + 64 + MARGIN, y + 8), spec['title'], FOREGROUND, font)
+    draw.text((x + 64 + MARGIN, y + 8 + LINE_HEIGHT), spec['subtitle'],
+              MUTED, font)
+    draw.text((x + 64 + MARGIN, y + 8 + LINE_HEIGHT * 2), spec['time'],
+              MUTED, font)
+    y += 64 + MARGIN
+
+    # Fitted modules, one row per slot type
+    for name, type_ids in slot_rows:
+        draw.text((x, y + 10), name, MUTED, font)
+        for position, type_id in enumerate(type_ids):
+            paste_icon(type_id, (x + 72 + position * (ICON_SIZE + 4), y),
+                       ICON_SIZE)
+        y += ICON_SIZE + 4
+    y += MARGIN
+
+    # Top attackers by damage
+    draw.text((x, y), 'Attackers ({:,})'.format(spec['attacker_count']),
+              FOREGROUND, font)
+    y += LINE_HEIGHT
+    for attacker in spec['attackers']:
+        paste_icon(attacker['ship_type_id'], (x, y), ICON_SIZE)
+        draw.text((x + ICON_SIZE + MARGIN, y + 10), attacker['name'],
+                  FOREGROUND, font)
+        damage = '{:,} damage'.format(attacker['damage'])
+        if attacker['final_blow']:
+            damage += ', final blow'
+        draw.text((x + 320, y + 10), damage, MUTED, font)
+        y += ICON_SIZE + 4
+    y += MARGIN
+
+    # ISK breakdown
+    for label, value in spec['values']:
+        draw.text((x, y), label, MUTED, font)
+        draw.text((x + 160, y), '{:,.0f} ISK'.format(value), FOREGROUND,
+                  font)
+        y += LINE_HEIGHT
+
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue(), time.perf_counter() - started
+
+
+class IconCache:
+    'Type icons from the image server, downloaded once and kept on disk'
+
+    def __init__(self, path: str = ICON_PATH):
+        self.logger = get_logger(__name__)
+        self.path = Path(path)
+        self.downloads = 0
+        self._pending: typing.Dict[int, asyncio.Future] = {}
+
+    async def get(self, session: aiohttp.ClientSession,
+                  type_id: int) -> typing.Optional[str]:
+        'Return the path of the icon of type_id, None if it is unavailable'
+        path = self.path / '{:d}.png'.format(type_id)
+        if path.exists():
+            return str(path)
+
+        # Concurrent requests for one icon share a single download
+        download = self._pending.get(type_id)
+        if download is None:
+            download = self._pending[type_id] = asyncio.ensure_future(
+                self._download(session, type_id, path))
+            download.add_done_callback(
+                lambda _: self._pending.pop(type_id, None))
+        return await asyncio.shield(download)
+
+    async def _download(self, session: aiohttp.ClientSession, type_id: int,
+                        path: Path) -> typing.Optional[str]:
+        try:
+            async with session.get(ICON_URL.format(type_id)) as resp:
+                resp.raise_for_status()
+                data = await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            self.logger.warning('Failed to download icon %d: %s', type_id,
+                                exception)
+            return None
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(str(tmp_path), str(path))
+        self.downloads += 1
+        return str(path)
+
+
+class CardRenderer:
+    '''Renders card specs to PNG images, reusing cards already drawn
+
+    A spec is the plain data shown on a card, see `get_card_spec`. Cards
+    are stored under the hash of their spec, and the least recently used
+    ones are deleted beyond cache_size cards.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 path: str = CARD_PATH, icon_path: str = ICON_PATH,
+                 workers: int = WORKERS, cache_size: int = CACHE_SIZE):
+        self.logger = get_logger(__name__)
+        self.loop = loop
+        self.path = Path(path)
+        self.icons = IconCache(icon_path)
+        self.workers = workers
+        self.cache_size = cache_size
+        self.rendered = 0
+        self.cache_hits = 0
+
+        self._executor: ProcessPoolExecutor = None
+        self._timings = deque(maxlen=TIMING_SAMPLES)
+        # Cached card paths, least recently used first
+        self._cached: typing.OrderedDict[Path, None] = OrderedDict(
+            (path, None) for _, path in sorted(
+                (path.stat().st_mtime, path)
+                for path in self.path.glob('*/*.png')))
+        self._evict()
+
+    def get_stats(self) -> dict:
+        'Return render counts and render time percentiles in milliseconds'
+        timings = sorted(self._timings)
+        return {
+            'rendered': self.rendered,
+            'cache_hits': self.cache_hits,
+            'icons': self.icons.downloads,
+            'p50': percentile(timings, 0.5) * 1000,
+            'p95': percentile(timings, 0.95) * 1000,
+        }
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def render(self, session: aiohttp.ClientSession,
+                     spec: dict) -> bytes:
+        'Return the PNG card for spec, drawing it if it is not cached'
+        key = hashlib.sha256(json.dumps(
+            [CARD_VERSION, spec], sort_keys=True).encode()).hexdigest()
+        path = self.path / key[:2] / '{}.png'.format(key)
+        if path in self._cached:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # Keep the order across restarts
+                os.utime(str(path))
+                self._cached.move_to_end(path)
+                self.cache_hits += 1
+                return data
+            except FileNotFoundError:
+                del self._cached[path]
+
+        type_ids = {spec['ship_type_id']}
+        type_ids.update(type_id for _, slot in spec['slots']
+                        for type_id in slot)
+        type_ids.update(attacker['ship_type_id']
+                        for attacker in spec['attackers'])
+        type_ids.discard(None)
+        paths = await asyncio.gather(*(self.icons.get(session, type_id)
+                                       for type_id in type_ids))
+        icons = {type_id: path for type_id, path in zip(type_ids, paths)
+                 if path is not None}
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        started = time.perf_counter()
+        data, render_time = await self.loop.run_in_executor(
+            self._executor, render_card, spec, icons)
+        self._timings.append(render_time)
+        self.rendered += 1
+        self.logger.debug('Rendered card %s in %.0fms (%.0fms with IPC)',
+                          key[:12], render_time * 1000,
+                          (time.perf_counter() - started) * 1000)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(str(tmp_path), str(path))
+        self._cached[path] = None
+        self._evict()
+        return data
+
+    def _evict(self):
+        while len(self._cached) > self.cache_size:
+            path, _ = self._cached.popitem(last=False)
+            try:
+                os.remove(str(path))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,136 @@
+'''
+Coalescing of killmail embeds into multi-embed messages.
+
+Embeds posted within a short window of the first one are sent together as
+a single message of up to 10 embeds, which cuts the number of Discord API
+calls per kill during fights.
+'''
+import asyncio
+import typing
+
+import discord
+
+from utils.log import get_logger
+
+MAX_EMBEDS = 10
+MAX_EMBED_CHARACTERS = 6000
+MAX_ATTACHMENT_BYTES = 8 * 1024 * 1024
+REACTION_POLICIES = ('union', 'skip')
+
+
+class EmbedCoalescer:
+    '''Batches embeds and their reactions into messages
+
+    `send` is a coroutine function taking a list of embeds, a list of
+    reactions and a list of (filename, data) attachments. With
+    `reaction_policy` 'union' a combined message gets every reaction any of
+    its kills asked for, with 'skip' it gets none.
+
+    Posting returns as soon as an embed joins a batch, except for the post
+    filling a batch, which waits for the message to be sent so a busy
+    channel pushes back on its callers. Batches flushed by the timer are
+    sent in the background and failures are passed to `on_error`.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 send: typing.Callable[[list, list, list],
+                                       typing.Awaitable],
+                 window: float, reaction_policy: str = 'union',
+                 on_error: typing.Callable[[list], typing.Awaitable] = None):
+        if reaction_policy not in REACTION_POLICIES:
+            raise ValueError('Unknown reaction policy: {}'.format(
+                reaction_policy))
+
+        self.logger = get_logger(__name__)
+        self.loop = loop
+        self.window = window
+        self.reaction_policy = reaction_policy
+        self.messages = 0
+        self.embeds = 0
+
+        self._send = send
+        self._on_error = on_error
+        self._batch = []
+        self._sending = set()
+        self._flush_handle: asyncio.TimerHandle = None
+
+    async def post(self, embed: discord.Embed, reactions: list,
+                   on_sent: typing.Callable[[], None] = None,
+                   attachment: typing.Tuple[str, bytes] = None):
+        '''Post an embed, either alone or in the next combined message.
+        on_sent is called once the message carrying it has been sent.'''
+        entry = (embed, reactions, on_sent, attachment)
+        if self.window <= 0:
+            await self._send_batch([entry])
+            return
+
+        if self._batch and (
+                self._characters() + len(embed) > MAX_EMBED_CHARACTERS
+                or attachment is not None and self._attachment_bytes()
+                + len(attachment[1]) > MAX_ATTACHMENT_BYTES):
+            self._flush()
+
+        self._batch.append(entry)
+        if len(self._batch) >= MAX_EMBEDS:
+            await self._post_batch(self._take_batch())
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.window,
+                                                      self._flush)
+
+    def _characters(self) -> int:
+        return sum(len(embed) for embed, _, _, _ in self._batch)
+
+    def _attachment_bytes(self) -> int:
+        return sum(len(attachment[1]) for _, _, _, attachment in self._batch
+                   if attachment is not None)
+
+    def _take_batch(self) -> list:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        return batch
+
+    def _flush(self):
+        batch = self._take_batch()
+        if batch:
+            task = self.loop.create_task(self._post_batch(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def drain(self):
+        'Send the pending batch and wait for all messages in flight'
+        self._flush()
+        if self._sending:
+            await asyncio.wait(list(self._sending))
+
+    async def _post_batch(self, batch: list):
+        try:
+            await self._send_batch(batch)
+        except Exception:  # pylint: disable=broad-except
+            if self._on_error is None:
+                self.logger.exception('Failed to post %d killmails',
+                                      len(batch))
+            else:
+                await self._on_error([embed for embed, _, _, _ in batch])
+
+    async def _send_batch(self, batch: list):
+        embeds = [embed for embed, _, _, _ in batch]
+        if len(batch) == 1 or self.reaction_policy == 'union':
+            reactions = list(dict.fromkeys(
+                reaction for _, reactions, _, _ in batch
+                for reaction in reactions))
+        else:
+            reactions = []
+        attachments = [attachment for _, _, _, attachment in batch
+                       if attachment is not None]
+
+        await self._send(embeds, reactions, attachments)
+
+        for _, _, on_sent, _ in batch:
+            if on_sent is not None:
+                on_sent()
+        self.messages += 1
+        self.embeds += len(embeds)
+        if len(batch) > 1:
+            self.logger.debug('Posted %d killmails in one message',
+                              len(batch))
@@ -0,0 +1,83 @@
+'''
+Deduplication of killmail packages by killID.
+
+Remembers recently seen kill IDs in a bounded time-windowed set which is
+periodically written to disk, so redelivered packages are dropped even
+across restarts.
+'''
+import asyncio
+import json
+import os
+from pathlib import Path
+
+from discord.ext import commands
+
+from utils.expiringset import ExpiringSet
+from utils.log import get_logger
+
+DEDUP_PATH = 'cache/killmail-dedup.json'
+DEDUP_SIZE = 100000
+DEDUP_WINDOW = 24 * 3600
+SAVE_INTERVAL = 60
+
+
+class KillmailDeduplicator:
+    '''Tracks seen kill IDs and persists them every SAVE_INTERVAL seconds'''
+
+    def __init__(self, bot: commands.Bot, path: str = DEDUP_PATH,
+                 size: int = DEDUP_SIZE, window: float = DEDUP_WINDOW):
+        self.logger = get_logger(__name__)
+        self.path = Path(path)
+        self.seen = ExpiringSet(size, window)
+        self.duplicates = 0
+        self._dirty = False
+
+        self.load()
+        self._save_task = bot.loop.create_task(self._save_loop())
+
+    def __len__(self) -> int:
+        return len(self.seen)
+
+    def check(self, kill_id: int) -> bool:
+        'Record kill_id as seen, returning False if it was seen before'
+        if self.seen.add(kill_id):
+            self._dirty = True
+            return True
+
+        self.duplicates += 1
+        return False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.seen.update(map(tuple, json.load(f)))
+        except FileNotFoundError:
+            return
+        except (ValueError, TypeError):
+            self.logger.exception('Ignoring corrupt dedup state %s',
+                                  self.path)
+            return
+        self.logger.info('Loaded %d seen kill IDs', len(self.seen))
+
+    def save(self):
+        'Atomically write the seen kill IDs to disk'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.seen.items(), f)
+        os.replace(str(tmp_path), str(self.path))
+        self._dirty = False
+
+    def stop(self):
+        self._save_task.cancel()
+        if self._dirty:
+            self.save()
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError:
+                    self.logger.exception('Failed to save dedup state')
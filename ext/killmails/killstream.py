@@ -0,0 +1,162 @@
+'''
+Killmail streaming cog for antinub-gregbot project.
+
+Subscribes to zKillboard's websocket killstream and feeds pushed killmails
+into the same pipeline as RedisQ polling. Selected with `mode: websocket`
+in the killmails ext config.
+'''
+import asyncio
+import json
+
+import aiohttp
+import discord.ext.commands as commands
+
+from .listener import (EXPONENTIAL_BACKOFF_FACTOR, INITIAL_BACKOFF,
+                       FetchError, RedisQListener, get_mode)
+from .models import Package, to_redisq_package
+from .recording import KILLSTREAM
+
+KILLSTREAM_URL = 'wss://zkillboard.com/websocket/'
+KILLSTREAM_HEARTBEAT = 30
+KILLSTREAM_MAXIMUM_BACKOFF = 300
+# How often to check the relevancy table for changed subscriptions while
+# no messages arrive
+RESUBSCRIBE_INTERVAL = 60
+
+
+def setup(bot: commands.Bot):
+    if get_mode(bot) == 'websocket':
+        bot.add_cog(KillstreamListener(bot))
+
+
+class KillstreamListener(RedisQListener, name='KillstreamListener'):
+    '''Receive killmails pushed over zKillboard's websocket and feed them
+    into the killmail pipeline
+
+    Subscribes to the channels listed in `killstream_channels`, or by
+    default to the corporations and alliances of the relevancy table and
+    routes and the systems near staging so zKillboard only sends killmails
+    that can be posted.'''
+
+    def __init__(self, bot: commands.Bot):
+        self.connected = False
+        self.subscriptions = set()
+        self.received_packages = 0
+        self.relevancy_table = bot.tdb.table('killmails.relevancies')
+        super(KillstreamListener, self).__init__(bot)
+
+    def get_health(self):
+        'Returns a string describing the status of this cog'
+        if self.connected:
+            response = ('\n  \u2714 Streaming {} channels ({} packages '
+                        'received, {} filtered)').format(
+                            len(self.subscriptions), self.received_packages,
+                            self.filtered_packages)
+        elif not self.polling_task.done():
+            response = '\n  \u2716 Reconnecting to the killstream'
+        else:
+            response = '\n  \u2716 Not listening'
+
+        return response + self.pipeline.get_health()
+
+    def get_channels(self) -> set:
+        'Return the killstream channels that should be subscribed to'
+        if 'killstream_channels' in self.config:
+            return set(self.config['killstream_channels'])
+
+        channels = {'{}:{}'.format(entry['type'], entry['value'])
+                    for entry in self.relevancy_table.all()
+                    if entry['type'] in ('corporation', 'alliance')}
+        poster = self.bot.get_cog('KillmailPoster')
+        if poster is not None:
+            # Routes without corporations or alliances match any killmail
+            if poster.routing.unrestricted:
+                return {'killstream'}
+            channels.update('corporation:{}'.format(corporation_id)
+                            for corporation_id in poster.routing.corporations)
+            channels.update('alliance:{}'.format(alliance_id)
+                            for alliance_id in poster.routing.alliances)
+            if poster.proximity.refresh():
+                poster.update_prefilter()
+            channels.update('system:{}'.format(system_id) for system_id
+                            in poster.proximity.solar_systems)
+        return channels or {'killstream'}
+
+    async def poll(self):
+        'Stay subscribed to the killstream forever, reconnecting on failure'
+        while True:
+            try:
+                await self.stream()
+            except FetchError as exception:
+                self.logger.warning(exception)
+            except Exception:
+                self.logger.exception('Unexpected error in killstream')
+            finally:
+                self.connected = False
+                self.subscriptions = set()
+
+            await asyncio.sleep(
+                min(self.backoff_wait, KILLSTREAM_MAXIMUM_BACKOFF))
+            self.backoff_wait *= EXPONENTIAL_BACKOFF_FACTOR
+
+    async def stream(self):
+        try:
+            async with self.bot.http.session.ws_connect(
+                    KILLSTREAM_URL, heartbeat=KILLSTREAM_HEARTBEAT) as ws:
+                self.connected = True
+                self.backoff_wait = INITIAL_BACKOFF
+                self.logger.info('Connected to the killstream')
+                await self.update_subscriptions(ws)
+
+                while True:
+                    try:
+                        message = await ws.receive(
+                            timeout=RESUBSCRIBE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        await self.update_subscriptions(ws)
+                        continue
+
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        package = self.read_package(message.data.encode())
+                        if package:
+                            await self.pipeline.put(package)
+                    elif message.type in (aiohttp.WSMsgType.CLOSE,
+                                          aiohttp.WSMsgType.CLOSED,
+                                          aiohttp.WSMsgType.ERROR):
+                        raise FetchError(
+                            'Killstream closed: {}'.format(ws.exception()
+                                                           or ws.close_code))
+
+        except aiohttp.ClientError as exception:
+            raise FetchError('Error reaching the killstream: {}'.format(
+                exception)) from exception
+
+    async def update_subscriptions(self, ws: aiohttp.ClientWebSocketResponse):
+        channels = self.get_channels()
+        for channel in self.subscriptions - channels:
+            await ws.send_json({'action': 'unsub', 'channel': channel})
+        for channel in channels - self.subscriptions:
+            await ws.send_json({'action': 'sub', 'channel': channel})
+        if channels != self.subscriptions:
+            self.logger.info('Subscribed to %d killstream channels',
+                             len(channels))
+        self.subscriptions = channels
+
+    def read_package(self, raw: bytes):
+        'Decode a killstream message, None if it is not a relevant killmail'
+        self.received_packages += 1
+        if self.recorder is not None:
+            self.record(raw)
+        if not self.prefilter(raw):
+            self.filtered_packages += 1
+            return None
+
+        message = json.loads(raw)
+        if 'killmail_id' not in message:
+            return None
+        return Package.from_dict(to_redisq_package(message))
+
+    def record(self, raw: bytes):
+        'Record a killmail frame as received, skipping status messages'
+        if b'"killmail_id"' in raw:
+            self.recorder.record(raw, source=KILLSTREAM)
@@ -1,7 +1,8 @@
 '''
 Killmail fetching cog for antinub-gregbot project.
 
-Polls zKillboard's RedisQ API and dispatches killmails as an event.
+Long-polls zKillboard's RedisQ API and feeds received packages into the
+killmail pipeline.
 '''
 import asyncio
 
@@ -10,92 +11,148 @@ import discord.ext.commands as commands
 
 from utils.log import get_logger
 
-from .poster import ZKILLBOARD_BASE_URL
+from .dedup import (DEDUP_PATH, DEDUP_SIZE, DEDUP_WINDOW,
+                    KillmailDeduplicator)
+from .models import Package
+from .pipeline import QUEUE_SIZE, WORKERS, KillmailPipeline
+from .recording import PackageRecorder
 
 REDISQ_URL = 'https://redisq.zkillboard.com/listen.php'
+REDISQ_TIME_TO_WAIT = 10
+NULL_PACKAGE = b'{"package":null}'
 INITIAL_BACKOFF = 0.1
 MAXIMUM_BACKOFF = 3600
 EXPONENTIAL_BACKOFF_FACTOR = 2
+MODES = ('redisq', 'websocket')
+
+
+def get_mode(bot: commands.Bot) -> str:
+    'Return the configured ingestion mode, RedisQ polling by default'
+    mode = (bot.ext_config or {}).get('killmails', {}).get('mode', 'redisq')
+    if mode not in MODES:
+        raise ValueError('Unknown killmail ingestion mode: {}'.format(mode))
+    return mode
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(RedisQListener(bot))
+    if get_mode(bot) == 'redisq':
+        bot.add_cog(RedisQListener(bot))
 
 
-class RedisQListener:
-    '''Poll RedisQ and dispatch killmail event containing recieved package'''
+class RedisQListener(commands.Cog, name='RedisQListener'):
+    '''Poll RedisQ and feed recieved packages into the killmail pipeline'''
     backoff_wait = INITIAL_BACKOFF
 
     def __init__(self, bot: commands.Bot):
         self.logger = get_logger(__name__)
         self.bot = bot
-        self.redisq_polling_task = self.listen_task_start()
-
-    def __unload(self):
-        self.redisq_polling_task.cancel()
+        self.config = (bot.ext_config or {}).get('killmails', {})
+        # RedisQ keeps packages for a known queueID while we are away, so
+        # keep it stable across restarts.
+        self.queue_id = self.config.get(
+            'redisq_queue_id', 'antinub-gregbot-{}'.format(bot.user.id))
+        self.filtered_packages = 0
+        self.recorder = None
+        if self.config.get('record_path'):
+            self.recorder = PackageRecorder(self.config['record_path'])
+        self.deduplicator = KillmailDeduplicator(
+            bot,
+            path=self.config.get('dedup_path', DEDUP_PATH),
+            size=self.config.get('dedup_size', DEDUP_SIZE),
+            window=self.config.get('dedup_window', DEDUP_WINDOW))
+        self.pipeline = KillmailPipeline(
+            bot, self.handle_package,
+            size=self.config.get('queue_size', QUEUE_SIZE),
+            workers=self.config.get('workers', WORKERS),
+            deduplicator=self.deduplicator, journal=self.journal_package)
+        self.polling_task = bot.loop.create_task(self.poll())
+
+    def cog_unload(self):
+        self.close()
+
+    def close(self):
+        self.polling_task.cancel()
+        self.pipeline.stop()
+        self.deduplicator.stop()
+        if self.recorder is not None:
+            self.recorder.close()
 
     def get_health(self):
         'Returns a string describing the status of this cog'
-        if not self.redisq_polling_task.done():
-            return '\n  \u2714 Listening'
-
-        return '\n  \u2716 Not listening'
-
-    def listen_task_start(self) -> asyncio.Task:
-        task = self.bot.loop.create_task(self.wait_for_package())
-        task.add_done_callback(self.listen_task_done)
-        return task
+        if not self.polling_task.done():
+            response = '\n  \u2714 Listening ({} packages filtered)'.format(
+                self.filtered_packages)
+        else:
+            response = '\n  \u2716 Not listening'
+
+        return response + self.pipeline.get_health()
+
+    async def poll(self):
+        'Long-poll RedisQ forever, waiting whenever the pipeline is full'
+        while True:
+            try:
+                package = await self.wait_for_package()
+            except FetchError as exception:
+                self.logger.warning(exception)
+                continue
+            except Exception:
+                self.logger.exception('Unexpected error in RedisQ polling')
+                continue
 
-    def listen_task_done(self, task: asyncio.Task):
-        try:
-            package = task.result()
             if package:
-                self.bot.dispatch(
-                    'killmail',
-                    package,
-                    debug_info=ZKILLBOARD_BASE_URL.format(package["killID"]))
+                await self.pipeline.put(package)
             else:
-                self.logger.debug('Ignoring null package')
-        except asyncio.CancelledError:
+                self.logger.debug('Ignoring null or filtered package')
+
+    def journal_package(self, package: Package):
+        poster = self.bot.get_cog('KillmailPoster')
+        if poster is not None:
+            poster.accept(package)
+
+    async def handle_package(self, package: Package):
+        poster = self.bot.get_cog('KillmailPoster')
+        if poster is None:
+            self.logger.warning('KillmailPoster is not loaded, dropping %s',
+                                package)
             return
-        except FetchError as exception:
-            self.logger.warning(exception)
-        except Exception:
-            message = 'Unexpected error in RedisQ polling'
-            self.logger.exception(message)
-
-        self.redisq_polling_task = self.listen_task_start()
+        await poster.on_killmail(package)
 
     async def wait_for_package(self):
-        delay = min(self.backoff_wait, MAXIMUM_BACKOFF)
-        await asyncio.sleep(delay)
+        # Only wait after failures, RedisQ long-polls on its own
+        if self.backoff_wait > INITIAL_BACKOFF:
+            await asyncio.sleep(min(self.backoff_wait, MAXIMUM_BACKOFF))
+        params = {'queueID': self.queue_id, 'ttw': REDISQ_TIME_TO_WAIT}
         try:
-            async with self.bot.http.session.get(REDISQ_URL) as resp:
+            async with self.bot.http.session.get(REDISQ_URL,
+                                                 params=params) as resp:
                 resp.raise_for_status()
                 self.backoff_wait = INITIAL_BACKOFF
-                package = await resp.json()
-                contents: dict = package['package']
-                if contents:
-                    return contents
-
-        except (aiohttp.errors.HttpProcessingError,
-                aiohttp.errors.ClientResponseError,
-                aiohttp.errors.ClientRequestError,
-                aiohttp.errors.ClientOSError,
-                aiohttp.errors.ClientDisconnectedError,
-                aiohttp.errors.ClientTimeoutError,
-                asyncio.TimeoutError) as exception:
+                raw = await resp.read()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
             self.backoff_wait *= EXPONENTIAL_BACKOFF_FACTOR
 
-            if hasattr(exception, 'code'):
+            if isinstance(exception, aiohttp.ClientResponseError):
                 message = 'Response from RedisQ: {} {}'.format(
-                    exception.code, exception.message)
+                    exception.status, exception.message)
             else:
                 message = 'Error reaching RedisQ: {}'.format(exception)
-            raise FetchError(message)
-
-    def process_result(self, package: dict):
-        raise NotImplementedError
+            raise FetchError(message) from exception
+
+        if self.recorder is not None and raw.strip() != NULL_PACKAGE:
+            self.recorder.record(raw)
+        if not self.prefilter(raw):
+            self.filtered_packages += 1
+            return None
+        return Package.from_redisq(raw)
+
+    def prefilter(self, raw: bytes) -> bool:
+        '''Cheaply drop packages that cannot be relevant before decoding them.
+        Everything passes if the poster is not loaded.'''
+        poster = self.bot.get_cog('KillmailPoster')
+        if poster is None:
+            return True
+        return poster.prefilter(raw)
 
 
 class FetchError(Exception):
@@ -0,0 +1,158 @@
+'''
+Compact typed representations of RedisQ packages.
+
+Killmail records are decoded into named tuples, which are far smaller and
+faster to walk than the nested dicts produced by the JSON decoder. Fields
+absent from the source document are None.
+'''
+import json
+import typing
+
+
+def _make(cls, raw: dict):
+    return cls._make(map(raw.get, cls._fields))
+
+
+def _dump(record) -> dict:
+    'Inverse of _make, leaving out absent fields'
+    raw = {}
+    for field, value in zip(record._fields, record):
+        if hasattr(value, '_fields'):
+            value = _dump(value)
+        elif isinstance(value, tuple):
+            value = [_dump(nested) for nested in value]
+        if value is not None:
+            raw[field] = value
+    return raw
+
+
+class Item(typing.NamedTuple):
+    item_type_id: int = None
+    flag: int = None
+    quantity_destroyed: int = None
+    quantity_dropped: int = None
+    singleton: int = None
+    items: tuple = ()
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Item':
+        item = _make(cls, raw)
+        return item._replace(
+            items=tuple(map(cls.from_dict, raw.get('items', ()))))
+
+
+class Victim(typing.NamedTuple):
+    character_id: int = None
+    corporation_id: int = None
+    alliance_id: int = None
+    faction_id: int = None
+    ship_type_id: int = None
+    damage_taken: int = None
+    items: typing.Tuple[Item, ...] = ()
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Victim':
+        victim = _make(cls, raw)
+        return victim._replace(
+            items=tuple(map(Item.from_dict, raw.get('items', ()))))
+
+
+class Attacker(typing.NamedTuple):
+    character_id: int = None
+    corporation_id: int = None
+    alliance_id: int = None
+    faction_id: int = None
+    ship_type_id: int = None
+    weapon_type_id: int = None
+    damage_done: int = None
+    final_blow: bool = None
+    security_status: float = None
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Attacker':
+        return _make(cls, raw)
+
+
+class Killmail(typing.NamedTuple):
+    killmail_id: int = None
+    killmail_time: str = None
+    solar_system_id: int = None
+    moon_id: int = None
+    war_id: int = None
+    victim: Victim = None
+    attackers: typing.Tuple[Attacker, ...] = ()
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Killmail':
+        killmail = _make(cls, raw)
+        return killmail._replace(
+            victim=Victim.from_dict(raw['victim']),
+            attackers=tuple(map(Attacker.from_dict, raw['attackers'])))
+
+
+class Zkb(typing.NamedTuple):
+    location_id: int = None
+    hash: str = None
+    fitted_value: float = None
+    total_value: float = None
+    points: int = None
+    npc: bool = None
+    solo: bool = None
+    awox: bool = None
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Zkb':
+        return cls(raw.get('locationID'), raw.get('hash'),
+                   raw.get('fittedValue'), raw.get('totalValue'),
+                   raw.get('points'), raw.get('npc'), raw.get('solo'),
+                   raw.get('awox'))
+
+    def to_dict(self) -> dict:
+        return {'locationID': self.location_id, 'hash': self.hash,
+                'fittedValue': self.fitted_value,
+                'totalValue': self.total_value, 'points': self.points,
+                'npc': self.npc, 'solo': self.solo, 'awox': self.awox}
+
+
+class Package:
+    '''A killmail package along with the state accumulated while posting it'''
+    __slots__ = ('kill_id', 'killmail', 'zkb', 'analysis', 'relevancy',
+                 'data')
+
+    def __init__(self, kill_id: int, killmail: Killmail, zkb: Zkb):
+        self.kill_id = kill_id
+        self.killmail = killmail
+        self.zkb = zkb
+        self.analysis = None
+        self.relevancy = None
+        self.data = None
+
+    def __repr__(self):
+        return '<Package kill_id={}>'.format(self.kill_id)
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Package':
+        return cls(raw['killID'], Killmail.from_dict(raw['killmail']),
+                   Zkb.from_dict(raw['zkb']))
+
+    def to_dict(self) -> dict:
+        'Return the package as RedisQ would deliver it'
+        return {'killID': self.kill_id, 'killmail': _dump(self.killmail),
+                'zkb': self.zkb.to_dict()}
+
+    @classmethod
+    def from_redisq(cls, raw: bytes) -> typing.Optional['Package']:
+        'Decode a raw RedisQ response body, None for an empty package'
+        contents = json.loads(raw)['package']
+        if not contents:
+            return None
+        return cls.from_dict(contents)
+
+
+def to_redisq_package(message: dict) -> dict:
+    '''Reshape a killstream message, an ESI killmail with a zkb key, into
+    the package RedisQ would have delivered'''
+    killmail = dict(message)
+    zkb = killmail.pop('zkb')
+    return {'killID': killmail['killmail_id'], 'killmail': killmail,
+            'zkb': zkb}
@@ -0,0 +1,110 @@
+'''
+Bounded killmail ingestion pipeline.
+
+Sources put packages into a bounded queue which is drained by a fixed pool
+of workers, so a burst never spawns more concurrent handlers than there are
+workers. A full queue blocks the source, which stops fetching until the
+workers catch up.
+'''
+import asyncio
+import time
+import typing
+
+from discord.ext import commands
+
+from utils.log import get_logger
+
+from .dedup import KillmailDeduplicator
+from .models import Package
+from .poster import ZKILLBOARD_BASE_URL
+
+QUEUE_SIZE = 100
+WORKERS = 4
+
+
+class KillmailPipeline:
+    '''Bounded queue of packages drained by a fixed pool of workers
+
+    `handler` is the coroutine function each package is passed to. Packages
+    already seen by `deduplicator` are dropped before being queued, the
+    others are passed to `journal` first so they survive a restart.'''
+
+    def __init__(self, bot: commands.Bot,
+                 handler: typing.Callable[[Package], typing.Awaitable],
+                 size: int = QUEUE_SIZE, workers: int = WORKERS,
+                 deduplicator: KillmailDeduplicator = None,
+                 journal: typing.Callable[[Package], None] = None):
+        self.logger = get_logger(__name__)
+        self.bot = bot
+        self.handler = handler
+        self.deduplicator = deduplicator
+        self.journal = journal
+        self.queue = asyncio.Queue(maxsize=size)
+
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.backpressure_events = 0
+        self.backpressure_time = 0.0
+
+        self._workers = [
+            bot.loop.create_task(self._work()) for _ in range(workers)
+        ]
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def put(self, package: Package):
+        'Enqueue a package, waiting for room if the queue is full'
+        if self.deduplicator is not None \
+                and not self.deduplicator.check(package.kill_id):
+            self.logger.debug('Dropping duplicate package %s', package)
+            return
+        if self.journal is not None:
+            self.journal(package)
+
+        if self.queue.full():
+            self.backpressure_events += 1
+            self.logger.debug('Killmail queue full, applying backpressure')
+            start = time.monotonic()
+            await self.queue.put(package)
+            self.backpressure_time += time.monotonic() - start
+        else:
+            self.queue.put_nowait(package)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+
+    def get_health(self) -> str:
+        'Returns a string describing the state of the queue and workers'
+        alive = sum(not worker.done() for worker in self._workers)
+        state = '\u2714' if alive == len(self._workers) else '\u2716'
+        return ('\n  {} {}/{} workers, queue {}/{} (max {}), {} processed, '
+                '{} failed, backpressure {} times for {:.1f}s').format(
+                    state, alive, len(self._workers), self.depth,
+                    self.queue.maxsize, self.max_depth, self.processed,
+                    self.failed, self.backpressure_events,
+                    self.backpressure_time) + self._dedup_health()
+
+    def _dedup_health(self) -> str:
+        if self.deduplicator is None:
+            return ''
+        return '\n  \u2714 {} kill IDs remembered, {} duplicates dropped' \
+            .format(len(self.deduplicator), self.deduplicator.duplicates)
+
+    async def _work(self):
+        while True:
+            package = await self.queue.get()
+            try:
+                await self.handler(package)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                await self.bot.on_error(
+                    'killmail',
+                    debug_info=ZKILLBOARD_BASE_URL.format(package.kill_id))
+            finally:
+                self.queue.task_done()
@@ -1,10 +1,11 @@
 import asyncio
 import functools
+import io
+import time
 import typing
 from datetime import datetime
 from enum import Enum
 
-import esipy
 import tinydb
 import discord
 from discord.ext import commands
@@ -12,12 +13,28 @@ from discord.ext import commands
 from utils.esicog import EsiCog
 from utils.kvtable import KeyValueTable
 from utils.log import get_logger
+from utils.messaging import send_embeds
+from utils.sde import SDE_PATH, get_static_data
+from utils.sendqueue import (BACKFILL, KILLMAIL, REACTION, get_send_scheduler,
+                             message_bucket)
+
+from .analyzer import RIG_SLOTS_ATTRIBUTE, AttributeIndex, analyze
+from .cards import (CACHE_SIZE, CARD_PATH, ICON_PATH, WORKERS,
+                    CardRenderer, get_card_spec, top_attackers)
+from .coalescer import EmbedCoalescer
+from .models import Package
+from .proximity import ProximityIndex
+from .relevancy import RelevancyIndex
+from .routing import RoutingTable
+from .stats import KILL, LOSS, STATS_PATH, KillStatsStore
+from .wal import WAL_PATH, WriteAheadLog
 
 ZKILLBOARD_BASE_URL = "https://zkillboard.com/kill/{:d}/"
 EVE_IMAGESERVER_BASE_URL = "https://imageserver.eveonline.com/Type/{:d}_64.png"
 REGIONAL_INDICATOR_F = "\U0001F1EB"
 ABYSSAL_SPACE_REGIONS = ("12000001", "12000002", "12000003", "12000004",
                          "12000005")
+MAGNATE_TYPE_ID = 29248
 
 
 def setup(bot: commands.Bot):
@@ -35,82 +52,345 @@ class Relevancy(Enum):
     IRRELEVANT = {}
     LOSSMAIL = {"colour": discord.Colour(0x7a0000)}
     KILLMAIL = {"colour": discord.Colour(0x007a00)}
+    ROUTED = {"colour": discord.Colour(0x7a7a7a)}
+    NEARBY = {"colour": discord.Colour(0x7a5200)}
 
 
-class KillmailPoster(EsiCog):
-    def __init__(self, bot: commands.Bot):
-        super(KillmailPoster, self).__init__(bot)
+class KillmailPoster(EsiCog, commands.Cog, name="KillmailPoster"):
+    def __init__(self, bot: commands.Bot,
+                 sender: typing.Callable[..., typing.Awaitable] = send_embeds,
+                 **esi_kwargs):
+        '''sender posts several embeds as one message, see
+        utils.messaging.send_embeds. esi_kwargs are passed on to EsiCog.'''
+        super(KillmailPoster, self).__init__(bot, **esi_kwargs)
 
         self.logger = get_logger(__name__)
         self.bot = bot
+        self.sender = sender
         self.config_table = KeyValueTable(self.bot.tdb, "killmails.config")
         self.channel = self.bot.get_channel(self.config_table["channel"])
-        self.esi_client = esipy.EsiClient(retry_requests=True)
         self.rigs_emoji = None
-        for emoji in self.channel.server.emojis:
+        for emoji in self.channel.guild.emojis:
             if str(emoji) == self.config_table["rigs_emoji"]:
                 self.rigs_emoji = emoji
                 break
         self.magnate_emoji = None
-        for emoji in self.channel.server.emojis:
+        for emoji in self.channel.guild.emojis:
             if str(emoji) == self.config_table["magnate_emoji"]:
                 self.magnate_emoji = emoji
                 break
         self.relevancy_table = self.bot.tdb.table("killmails.relevancies")
         self.relevancy = tinydb.Query()
-
-    async def on_killmail(self, package: dict, **dummy_kwargs):
-        package["relevancy"] = await self.is_relevant(package)
-        if package["relevancy"] is Relevancy.IRRELEVANT:
-            self.logger.debug("Ignoring irrelevant killmail")
-            return
+        config = (self.bot.ext_config or {}).get("killmails", {})
+        self.static_data = get_static_data(config.get("sde_path", SDE_PATH))
+        self.rig_slots = AttributeIndex(self.static_data, RIG_SLOTS_ATTRIBUTE)
+        self.relevancy_index = RelevancyIndex(
+            self.bot, self.relevancy_table, self.get_relevant_corporations)
+
+        self.coalesce_window = config.get("coalesce_window", 0)
+        self.coalesce_reactions = config.get("coalesce_reactions", "union")
+        self.coalescers: typing.Dict[typing.Tuple[int, int],
+                                     EmbedCoalescer] = {}
+        self.routing = RoutingTable.from_config(config.get("routes", []))
+        proximity = config.get("proximity", {})
+        self.proximity = ProximityIndex(self.static_data,
+                                        proximity.get("solar_systems", ()),
+                                        proximity.get("max_jumps", 0))
+        self.update_prefilter()
+        self.wal = WriteAheadLog(self.bot.loop,
+                                 config.get("wal_path", WAL_PATH))
+        self.cards = None
+        if config.get("cards", False):
+            self.cards = CardRenderer(self.bot.loop,
+                                      config.get("card_path", CARD_PATH),
+                                      config.get("icon_path", ICON_PATH),
+                                      config.get("card_workers", WORKERS),
+                                      config.get("card_cache_size",
+                                                 CACHE_SIZE))
+        self.stats = KillStatsStore(self.bot,
+                                    config.get("stats_path", STATS_PATH))
+        if self.wal.recovered:
+            self.bot.loop.create_task(self.replay_wal(self.wal.recovered))
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self.close())
+
+    def update_prefilter(self):
+        # Routed and nearby killmails need not involve a relevant corporation
+        self.relevancy_index.extend_prefilter(
+            self.routing.corporations, self.routing.alliances,
+            self.routing.unrestricted, self.proximity.solar_systems)
+
+    def prefilter(self, raw: bytes) -> bool:
+        'Check whether a raw package can be relevant without decoding it'
+        if self.proximity.refresh():
+            self.update_prefilter()
+        return self.relevancy_index.prefilter(raw)
+
+    async def close(self):
+        'Stop background work once every pending killmail has been sent'
+        self.relevancy_index.stop()
+        self.stats.stop()
+        await self.drain()
+        self.wal.stop()
+        if self.cards is not None:
+            self.cards.stop()
+        await self.close_esi_session()
+
+    async def drain(self):
+        'Wait until every coalesced killmail has been sent'
+        await asyncio.gather(*(coalescer.drain()
+                               for coalescer in self.coalescers.values()))
+
+    def get_health(self):
+        'Returns a string describing the status of this cog'
+        if self.relevancy_index.ready:
+            response = ('\n  \u2714 Relevancy index: {} corporations, '
+                        'built {:.0f}s ago').format(
+                            len(self.relevancy_index),
+                            self.relevancy_index.age)
+        else:
+            response = '\n  \u2716 Relevancy index not built yet'
+
+        stats = self.get_cache_stats()
+        response += ('\n  \u2714 ESI cache: {hits} memory hits, {disk_hits} '
+                     'disk hits, {misses} misses ({hit_ratio:.0%}), '
+                     '{size} entries').format(**stats)
+        stats = self.get_client_stats()
+        response += ('\n  \u2714 ESI client: {requests} requests, '
+                     '{not_modified} not modified, {fresh_hits} served '
+                     'before expiry').format(**stats)
+        if self.proximity.ready:
+            response += ("\n  \u2714 Proximity: {} systems within {} jumps "
+                         "of {} staging systems").format(
+                             len(self.proximity), self.proximity.max_jumps,
+                             len(self.proximity.staging_systems))
+        elif self.proximity:
+            response += "\n  \u2716 Proximity: SDE not imported"
+        if self.routing:
+            response += "\n  \u2714 Routing: {} routes".format(
+                len(self.routing))
+        if self.coalesce_window > 0:
+            response += ('\n  \u2714 Coalescing: {} killmails in {} '
+                         'messages').format(
+                             sum(coalescer.embeds for coalescer
+                                 in self.coalescers.values()),
+                             sum(coalescer.messages for coalescer
+                                 in self.coalescers.values()))
+        if self.cards is not None:
+            response += ('\n  \u2714 Cards: {rendered} rendered (p50 '
+                         '{p50:.0f}ms, p95 {p95:.0f}ms), {cache_hits} cached, '
+                         '{icons} icons downloaded').format(
+                             **self.cards.get_stats())
+        response += ('\n  \u2714 WAL: {} pending, {} appended, {} '
+                     'syncs').format(len(self.wal), self.wal.appended,
+                                     self.wal.syncs)
+        response += "\n  \u2714 Kill statistics: {} kills".format(
+            len(self.stats))
+        return response
+
+    def accept(self, package: Package):
+        'Journal a package queued for on_killmail, so it survives a restart'
+        self.wal.append(package.kill_id, {"package": package.to_dict()})
+
+    async def on_killmail(self, package: Package, backfill: bool = False,
+                          **dummy_kwargs):
+        # An unbuilt index would classify every killmail as irrelevant
+        await self.relevancy_index.wait_ready()
+        package.analysis = analyze(package.killmail,
+                                   self.relevancy_index.corporations)
+        package.relevancy = self.is_relevant(package)
+        if package.relevancy is Relevancy.IRRELEVANT:
+            if self.proximity.distance(
+                    package.killmail.solar_system_id) is not None:
+                package.relevancy = Relevancy.NEARBY
+            elif self.match_routes(package):
+                package.relevancy = Relevancy.ROUTED
+            else:
+                self.logger.debug("Ignoring irrelevant killmail")
+                self.wal.done(package.kill_id)
+                return
+        else:
+            self.stats.add(package,
+                           LOSS if package.relevancy is Relevancy.LOSSMAIL
+                           else KILL, self.relevancy_index.corporations)
+        priority = BACKFILL if backfill else KILLMAIL
+        self.wal.append(package.kill_id, {"package": package.to_dict(),
+                                          "relevancy": package.relevancy.name,
+                                          "priority": priority})
+        await self.post(package, priority)
+
+    async def post(self, package: Package, priority: int = KILLMAIL):
         self.logger.info("Posting %s",
-                         ZKILLBOARD_BASE_URL.format(package["killID"]))
-        package["data"] = await self.fetch_data(package)
+                         ZKILLBOARD_BASE_URL.format(package.kill_id))
+        package.data = await self.fetch_data(package)
+        channels = self.get_destinations(package)
+        if not channels:
+            self.logger.debug("No destination for %d", package.kill_id)
+            self.wal.done(package.kill_id)
+            return
+
         embed = await self.generate_embed(package)
-        message = await self.bot.send_message(self.channel, embed=embed)
-        await self.add_reactions(message, package)
+        attachment = None
+        if self.cards is not None:
+            attachment = await self.render_card(package, embed)
+        reactions = self.get_reactions(package)
+        # The entry is done once the killmail reached every destination
+        remaining = [len(channels)]
+
+        def on_sent():
+            remaining[0] -= 1
+            if not remaining[0]:
+                self.wal.done(package.kill_id)
+
+        await asyncio.gather(*(
+            self.get_coalescer(channel, priority).post(embed, reactions,
+                                                       on_sent, attachment)
+            for channel in channels))
+
+    async def render_card(self, package: Package, embed: discord.Embed
+                          ) -> typing.Optional[typing.Tuple[str, bytes]]:
+        '''Render the card image of a killmail and show it in embed.
+        Returns the attachment, None if rendering failed.'''
+        try:
+            names = dict(package.data["names"])
+            names.update(await self.resolve_names(
+                self.bot.loop,
+                [attacker.character_id or attacker.corporation_id
+                 for attacker in top_attackers(package.killmail)]))
+            spec = get_card_spec(package, embed.title,
+                                 embed.description.split("\n")[0], names,
+                                 embed.colour.to_rgb())
+            data = await self.cards.render(self.bot.http.session, spec)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception("Failed to render the card of %d",
+                                  package.kill_id)
+            return None
+
+        filename = "{:d}.png".format(package.kill_id)
+        embed.set_image(url="attachment://" + filename)
+        return filename, data
+
+    def match_routes(self, package: Package) -> int:
+        'Bitmask of the routes the killmail can match before any lookups'
+        return self.routing.match_early(package.analysis.corporation_ids,
+                                        package.analysis.alliance_ids,
+                                        package.zkb.total_value)
+
+    def get_destinations(self, package: Package) -> list:
+        'Channels the killmail should be posted to'
+        channel_ids = []
+        if package.relevancy in (Relevancy.LOSSMAIL, Relevancy.KILLMAIL,
+                                 Relevancy.NEARBY):
+            channel_ids.append(self.channel.id)
+
+        routes = self.match_routes(package)
+        if routes:
+            for channel_id in self.routing.match(
+                    routes, package.data["region"]["region_id"],
+                    package.data["ship_type"].get("group_id")):
+                if channel_id not in channel_ids:
+                    channel_ids.append(channel_id)
+
+        channels = []
+        for channel_id in channel_ids:
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                self.logger.warning("Unknown killmail channel %d", channel_id)
+            else:
+                channels.append(channel)
+        return channels
+
+    def get_coalescer(self, channel, priority: int) -> EmbedCoalescer:
+        'Return the coalescer for killmails to channel sent at priority'
+        key = (channel.id, priority)
+        coalescer = self.coalescers.get(key)
+        if coalescer is None:
+            coalescer = self.coalescers[key] = EmbedCoalescer(
+                self.bot.loop,
+                functools.partial(self.send_killmails, channel, priority),
+                self.coalesce_window, self.coalesce_reactions,
+                self.on_coalesced_error)
+        return coalescer
+
+    async def replay_wal(self, entries: typing.List[dict]):
+        '''Post the killmails that were still pending when the bot stopped.
+        Packages that were still queued are classified first.'''
+        for entry in entries:
+            package = Package.from_dict(entry["value"]["package"])
+            try:
+                if "relevancy" not in entry["value"]:
+                    await self.on_killmail(package)
+                    continue
+                package.analysis = analyze(package.killmail,
+                                           self.relevancy_index.corporations)
+                package.relevancy = Relevancy[entry["value"]["relevancy"]]
+                await self.post(package,
+                                entry["value"].get("priority", KILLMAIL))
+            except Exception:  # pylint: disable=broad-except
+                await self.bot.on_error(
+                    "killmail",
+                    debug_info=ZKILLBOARD_BASE_URL.format(package.kill_id))
+
+    async def send_killmails(self, channel, priority: int,
+                             embeds: typing.List[discord.Embed],
+                             reactions: list, attachments: list):
+        scheduler = get_send_scheduler(self.bot.loop)
+        files = [discord.File(io.BytesIO(data), filename)
+                 for filename, data in attachments]
+        if len(embeds) == 1:
+            message = await scheduler.send_message(
+                priority, channel, embed=embeds[0],
+                file=files[0] if files else None)
+        else:
+            message = await scheduler.submit(
+                priority, message_bucket(channel), self.sender, channel,
+                embeds, files=files)
+
+        # Backfilled killmails never get ahead of live reactions
+        reaction_priority = REACTION if priority == KILLMAIL else priority
+        for reaction in reactions:
+            await scheduler.add_reaction(message, reaction,
+                                         reaction_priority)
+
+    async def on_coalesced_error(self, embeds: typing.List[discord.Embed]):
+        await self.bot.on_error(
+            "killmail", debug_info=" ".join(embed.url for embed in embeds))
 
-    async def add_reactions(self, message: discord.Message, package: dict):
-        relevancy = package["relevancy"]
-        if relevancy is Relevancy.LOSSMAIL:
-            await self.bot.add_reaction(message, REGIONAL_INDICATOR_F)
+    def get_reactions(self, package: Package) -> list:
+        reactions = []
+        if package.relevancy is Relevancy.LOSSMAIL:
+            reactions.append(REGIONAL_INDICATOR_F)
 
         if self.rigs_emoji and self.should_add_rig_emoji(package):
-            await self.bot.add_reaction(message, self.rigs_emoji)
+            reactions.append(self.rigs_emoji)
 
         if self.magnate_emoji and self.should_add_magnate_emoji(package):
-            await self.bot.add_reaction(message, self.magnate_emoji)
-
-    def should_add_rig_emoji(self, package: dict) -> bool:
-        # Flags 92, 93, 94 are rig slots
-        slots = [val["flag"] for val in package["killmail"]["victim"]["items"]]
-        number_of_rigs = len(list(filter(lambda x: x in (92, 93, 94), slots)))
-        max_rigs = list(
-            filter(
-                # number of rig slots on ship
-                lambda x: x["attribute_id"] == 1137,
-                package["data"]["ship_type"]["dogma_attributes"]))
-        if max_rigs and number_of_rigs < max_rigs[0]["value"]:
-            return True
-
-        return False
-
-    def should_add_magnate_emoji(self, package: dict) -> bool:
-        magnate_ship_id = 29248
-        if package["killmail"]["victim"].get("ship_type_id", None) == magnate_ship_id:
-            return True
-
-        for attacker in package["killmail"]["attackers"]:
-            if attacker.get("ship_type_id", None) == magnate_ship_id:
-                return True
-
-        return False
-
-    async def generate_embed(self, package: dict) -> discord.Embed:
+            reactions.append(self.magnate_emoji)
+
+        return reactions
+
+    def should_add_rig_emoji(self, package: Package) -> bool:
+        max_rigs = self.rig_slots.get(package.killmail.victim.ship_type_id,
+                                      package.data["ship_type"])
+        return max_rigs is not None and \
+            package.analysis.rigs_fitted < max_rigs
+
+    def should_add_magnate_emoji(self, package: Package) -> bool:
+        return MAGNATE_TYPE_ID in package.analysis.ship_type_ids
+
+    async def generate_embed(self, package: Package) -> discord.Embed:
         embed = discord.Embed()
-        data = package["data"]
-        names = {k: v["name"] for (k, v) in data.items()}
+        data = package.data
+        victim = package.killmail.victim
+        names = {k: data[k]["name"] for k in ("solar_system", "region",
+                                              "ship_type")}
+        affiliation_id = self.get_affiliation_id(victim)
+        names["affiliation"] = data["names"].get(affiliation_id) or str(
+            affiliation_id)
+        if victim.character_id is not None:
+            names["character"] = data["names"].get(victim.character_id) or str(
+                victim.character_id)
 
         identity = names["affiliation"]
         if "character" in names:
@@ -122,81 +402,103 @@ class KillmailPoster(EsiCog):
             solar_system = "Abyssal Space"
             location = solar_system
 
+        proximity = ""
+        distance = self.proximity.distance(package.killmail.solar_system_id)
+        if distance is not None:
+            staging_system = self.static_data.get_solar_system(
+                self.proximity.nearest(package.killmail.solar_system_id))
+            proximity = "{} jumps from {}\n".format(
+                distance, staging_system["name"])
+
         embed.title = "{solar_system} | {0[ship_type]} | {identity}".format(
             names, identity=identity, solar_system=solar_system)
         embed.description = ("{identity} lost their {0[ship_type]} in "
                              "{location}\n"
                              "Total Value: {1:,} ISK\n"
-                             "\u200b").format(
+                             "{proximity}\u200b").format(
                                  names,
-                                 package["zkb"]["totalValue"],
+                                 package.zkb.total_value,
                                  identity=identity,
-                                 location=location)
-        embed.url = ZKILLBOARD_BASE_URL.format(package["killID"])
+                                 location=location,
+                                 proximity=proximity)
+        embed.url = ZKILLBOARD_BASE_URL.format(package.kill_id)
         embed.timestamp = datetime.strptime(
-            package["killmail"]["killmail_time"], "%Y-%m-%dT%H:%M:%SZ")
-        embed.colour = package["relevancy"].colour
-        ship_type_id = package["killmail"]["victim"]["ship_type_id"]
+            package.killmail.killmail_time, "%Y-%m-%dT%H:%M:%SZ")
+        embed.colour = package.relevancy.colour
+        ship_type_id = package.killmail.victim.ship_type_id
         embed.set_thumbnail(url=EVE_IMAGESERVER_BASE_URL.format(ship_type_id))
 
         return embed
 
-    async def fetch_data(self, package: dict) -> dict:
-        esi_app = await self.get_esi_app()
-        esi_request = functools.partial(self.esi_request, self.bot.loop,
-                                        self.esi_client)
-        data = {}
-
-        operation = esi_app.op["get_universe_systems_system_id"](
-            system_id=package["killmail"]["solar_system_id"])
-        response = await esi_request(operation)
-        data["solar_system"] = response.data
-
-        operation = esi_app.op["get_universe_constellations_constellation_id"](
-            constellation_id=response.data["constellation_id"])
-        response = await esi_request(operation)
-        operation = esi_app.op["get_universe_regions_region_id"](
-            region_id=response.data["region_id"])
-        response = await esi_request(operation)
-        data["region"] = response.data
-
-        operation = esi_app.op["get_universe_types_type_id"](
-            type_id=package["killmail"]["victim"]["ship_type_id"])
-        response = await esi_request(operation)
-        data["ship_type"] = response.data
-
-        if "character_id" in package["killmail"]["victim"]:
-            operation = esi_app.op["get_characters_character_id"](
-                character_id=package["killmail"]["victim"]["character_id"])
-            response = await esi_request(operation)
-            data["character"] = response.data
-
-        if "alliance_id" in package["killmail"]["victim"]:
-            operation = esi_app.op["get_alliances_alliance_id"](
-                alliance_id=package["killmail"]["victim"]["alliance_id"])
-            response = await esi_request(operation)
-            data["affiliation"] = response.data
-        else:
-            operation = esi_app.op["get_corporations_corporation_id"](
-                corporation_id=package["killmail"]["victim"]["corporation_id"])
-            response = await esi_request(operation)
-            data["affiliation"] = response.data
+    async def fetch_data(self, package: Package) -> dict:
+        timings = {}
+
+        async def timed(stage, coroutine):
+            start = time.perf_counter()
+            try:
+                return await coroutine
+            finally:
+                timings[stage] = time.perf_counter() - start
+
+        # Static data comes from the SDE when it is imported, ESI otherwise
+        async def lookup(static_getter, op_name, **params):
+            record = static_getter(*params.values())
+            if record is None:
+                record = await self.esi_cached_request(op_name, **params)
+            return record
+
+        # Only the location lookups depend on each other, everything else
+        # is fetched alongside them.
+        async def fetch_location():
+            solar_system = await timed("solar_system", lookup(
+                self.static_data.get_solar_system,
+                "get_universe_systems_system_id",
+                system_id=package.killmail.solar_system_id))
+            constellation = await timed("constellation", lookup(
+                self.static_data.get_constellation,
+                "get_universe_constellations_constellation_id",
+                constellation_id=solar_system["constellation_id"]))
+            region = await timed("region", lookup(
+                self.static_data.get_region,
+                "get_universe_regions_region_id",
+                region_id=constellation["region_id"]))
+            return solar_system, region
+
+        victim = package.killmail.victim
+        stages = {
+            "location": fetch_location(),
+            "ship_type": timed("ship_type", lookup(
+                self.static_data.get_type, "get_universe_types_type_id",
+                type_id=victim.ship_type_id)),
+            "names": timed("names", self.resolve_names(
+                self.bot.loop,
+                (victim.character_id, self.get_affiliation_id(victim)))),
+        }
+
+        start = time.perf_counter()
+        data = dict(zip(stages, await asyncio.gather(*stages.values())))
+        data["solar_system"], data["region"] = data.pop("location")
+
+        self.logger.debug(
+            "Fetched data for %d in %.0fms (%s)", package.kill_id,
+            (time.perf_counter() - start) * 1000,
+            ", ".join("{}: {:.0f}ms".format(stage, elapsed * 1000)
+                      for stage, elapsed in timings.items()))
 
         return data
 
-    async def is_relevant(self, package: dict) -> Relevancy:
-        relevant_corporations = await self.get_relevant_corporations()
+    @staticmethod
+    def get_affiliation_id(victim) -> int:
+        if victim.alliance_id is not None:
+            return victim.alliance_id
+        return victim.corporation_id
 
-        victim = package["killmail"]["victim"]
-        if victim["corporation_id"] in relevant_corporations:
+    @staticmethod
+    def is_relevant(package: Package) -> Relevancy:
+        if package.analysis.victim_relevant:
             return Relevancy.LOSSMAIL
-
-        for attacker in package["killmail"]["attackers"]:
-            if "corporation_id" not in attacker:
-                continue  # Some NPCs do not have a corporation.
-            if attacker["corporation_id"] in relevant_corporations:
-                return Relevancy.KILLMAIL
-
+        if package.analysis.attacker_relevant:
+            return Relevancy.KILLMAIL
         return Relevancy.IRRELEVANT
 
     async def get_relevant_corporations(self) -> typing.Set[int]:
@@ -209,14 +511,16 @@ class KillmailPoster(EsiCog):
         alliance_list = [entry["value"] for entry in alliance_configs]
 
         esi_app = await self.get_esi_app()
-        esi_request = functools.partial(self.esi_request, self.bot.loop,
-                                        self.esi_client)
         operations = [
             esi_app.op["get_alliances_alliance_id_corporations"](
                 alliance_id=alliance_id) for alliance_id in alliance_list
         ]
-        responses = await asyncio.gather(*map(esi_request, operations))
-        for response in responses:
+        responses = await asyncio.gather(*map(self.esi_request, operations))
+        for alliance_id, response in zip(alliance_list, responses):
+            if response.status != 200:
+                raise RuntimeError(
+                    "Corporations of alliance {} responded with {}".format(
+                        alliance_id, response.status))
             corp_list.update(response.data)
 
         return corp_list
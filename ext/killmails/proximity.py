@@ -0,0 +1,109 @@
+'''
+Jump distances from staging systems.
+
+The stargate graph is read from the SDE once and searched breadth first from
+every staging system, leaving a table of the distance to each system within
+range. Checking a killmail is then a single array lookup.
+'''
+import typing
+from array import array
+from collections import defaultdict
+
+from utils.log import get_logger
+from utils.sde import StaticData
+
+# Distances are stored as signed bytes, -1 marks systems out of range
+MAX_JUMPS = 127
+
+
+class ProximityIndex:
+    '''Systems within max_jumps of any of the staging systems
+
+    The table is rebuilt whenever a different SDE is loaded. Without an SDE
+    nothing is in range.'''
+
+    def __init__(self, static_data: StaticData,
+                 staging_systems: typing.Iterable[int], max_jumps: int):
+        self.logger = get_logger(__name__)
+        self.static_data = static_data
+        self.staging_systems = frozenset(staging_systems)
+        self.max_jumps = min(max_jumps, MAX_JUMPS)
+        self.solar_systems: typing.FrozenSet[int] = frozenset()
+
+        self._version = None
+        self._offset = 0
+        self._distances = array('b')
+        self._nearest = array('l')
+        self.refresh()
+
+    def __bool__(self) -> bool:
+        return bool(self.staging_systems)
+
+    def __len__(self) -> int:
+        return len(self.solar_systems)
+
+    @property
+    def ready(self) -> bool:
+        return self._version is not None
+
+    def refresh(self) -> bool:
+        'Rebuild the table if a different SDE was loaded since the last build'
+        if not self.staging_systems \
+                or self._version == self.static_data.version:
+            return False
+        self.build()
+        return True
+
+    def distance(self, system_id: int) -> typing.Optional[int]:
+        'Jumps from the nearest staging system, None if out of range'
+        if system_id is None:
+            return None
+        index = system_id - self._offset
+        if 0 <= index < len(self._distances):
+            distance = self._distances[index]
+            if distance >= 0:
+                return distance
+        return None
+
+    def nearest(self, system_id: int) -> typing.Optional[int]:
+        'The staging system closest to system_id, None if out of range'
+        if self.distance(system_id) is None:
+            return None
+        return self._nearest[system_id - self._offset]
+
+    def build(self):
+        graph = defaultdict(list)
+        for from_system_id, to_system_id in self.static_data.get_jumps():
+            graph[from_system_id].append(to_system_id)
+
+        # Multi-source breadth first search, one frontier per jump
+        found = {system_id: (0, system_id)
+                 for system_id in self.staging_systems}
+        frontier = list(self.staging_systems)
+        for distance in range(1, self.max_jumps + 1):
+            next_frontier = []
+            for system_id in frontier:
+                nearest = found[system_id][1]
+                for neighbour in graph.get(system_id, ()):
+                    if neighbour not in found:
+                        found[neighbour] = (distance, nearest)
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+
+        self._offset = min(found)
+        size = max(found) - self._offset + 1
+        distances = array('b', [-1]) * size
+        nearest = array('l', [0]) * size
+        for system_id, (distance, staging_system) in found.items():
+            distances[system_id - self._offset] = distance
+            nearest[system_id - self._offset] = staging_system
+        self._distances = distances
+        self._nearest = nearest
+        self.solar_systems = frozenset(found)
+        self._version = self.static_data.version
+
+        if not graph:
+            self.logger.warning('No stargate graph, only the staging '
+                                'systems are in range')
+        self.logger.info('Built proximity index: %d systems within %d jumps',
+                         len(found), self.max_jumps)
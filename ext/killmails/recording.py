@@ -0,0 +1,62 @@
+'''
+Recording of raw RedisQ packages to gzip-compressed JSON lines.
+
+Each line holds the time a package was received and the raw response body,
+so a capture can be replayed byte for byte through the listener. Killstream
+frames are recorded as received and reshaped into RedisQ bodies when read,
+so every capture replays through the RedisQ listener.
+'''
+import gzip
+import json
+import time
+import typing
+from pathlib import Path
+
+from .models import to_redisq_package
+
+FLUSH_INTERVAL = 5
+REDISQ = 'redisq'
+KILLSTREAM = 'killstream'
+
+
+class PackageRecorder:
+    '''Appends raw packages to a compressed JSONL capture'''
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.recorded = 0
+        self._file = gzip.open(str(self.path), 'at', encoding='utf-8')
+        self._flushed_at = time.monotonic()
+
+    def record(self, raw: bytes, received: float = None,
+               source: str = REDISQ):
+        line = {
+            'received': time.time() if received is None else received,
+            'body': raw.decode('utf-8')
+        }
+        if source != REDISQ:
+            line['source'] = source
+        self._file.write(json.dumps(line) + '\n')
+        self.recorded += 1
+
+        if time.monotonic() - self._flushed_at > FLUSH_INTERVAL:
+            self._file.flush()
+            self._flushed_at = time.monotonic()
+
+    def close(self):
+        self._file.close()
+
+
+def read_recording(path: str) -> typing.Iterator[typing.Tuple[float, bytes]]:
+    '''Yield (received, raw RedisQ body) pairs from a capture in recorded
+    order'''
+    with gzip.open(str(path), 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                raw = entry['body'].encode('utf-8')
+                if entry.get('source') == KILLSTREAM:
+                    raw = json.dumps({'package': to_redisq_package(
+                        json.loads(raw))}).encode('utf-8')
+                yield entry['received'], raw
@@ -0,0 +1,152 @@
+'''
+In-memory index of the corporations whose kills and losses are relevant.
+
+The index is rebuilt in the background on a schedule and whenever the
+relevancy table changes, so checking a package never touches TinyDB or ESI.
+'''
+import asyncio
+import re
+import time
+import typing
+
+from discord.ext import commands
+
+from utils.log import get_logger
+
+REFRESH_INTERVAL = 3600
+TABLE_POLL_INTERVAL = 30
+RETRY_INTERVAL = 60
+CORPORATION_ID_PATTERN = re.compile(rb'"corporation_id"\s*:\s*(\d+)')
+ALLIANCE_ID_PATTERN = re.compile(rb'"alliance_id"\s*:\s*(\d+)')
+SOLAR_SYSTEM_ID_PATTERN = re.compile(rb'"solar_system_id"\s*:\s*(\d+)')
+
+
+class RelevancyIndex:
+    '''Frozen set of relevant corporation IDs kept fresh by a background task
+
+    `builder` is a coroutine function returning the set of corporation IDs,
+    `table` is the TinyDB table it is built from.'''
+
+    def __init__(self, bot: commands.Bot, table,
+                 builder: typing.Callable[[], typing.Awaitable[set]],
+                 refresh_interval: float = REFRESH_INTERVAL):
+        self.logger = get_logger(__name__)
+        self.table = table
+        self.refresh_interval = refresh_interval
+        self.corporations: typing.FrozenSet[int] = frozenset()
+        self.tokens: typing.FrozenSet[bytes] = frozenset()
+        self.alliance_tokens: typing.FrozenSet[bytes] = frozenset()
+        self.solar_system_tokens: typing.FrozenSet[bytes] = frozenset()
+        self.passthrough = False
+        self.version = 0
+        self.built_at: float = None
+
+        self._builder = builder
+        self._extra_corporations: typing.FrozenSet[int] = frozenset()
+        self._table_snapshot = None
+        self._invalidated = asyncio.Event()
+        self._built = asyncio.Event()
+        self._refresh_task = bot.loop.create_task(self._refresh_loop())
+
+    def __contains__(self, corporation_id: int) -> bool:
+        return corporation_id in self.corporations
+
+    def __len__(self) -> int:
+        return len(self.corporations)
+
+    @property
+    def ready(self) -> bool:
+        return self.built_at is not None
+
+    @property
+    def age(self) -> typing.Optional[float]:
+        'Seconds since the index was last rebuilt, None if never built'
+        if self.built_at is None:
+            return None
+        return time.monotonic() - self.built_at
+
+    def prefilter(self, raw: bytes) -> bool:
+        '''Check whether a raw JSON document mentions a relevant corporation
+        without decoding it. Everything passes until the index is built.'''
+        if self.passthrough or not self.ready \
+                or not self.tokens.isdisjoint(
+                    CORPORATION_ID_PATTERN.findall(raw)):
+            return True
+        if self.alliance_tokens and not self.alliance_tokens.isdisjoint(
+                ALLIANCE_ID_PATTERN.findall(raw)):
+            return True
+        return bool(self.solar_system_tokens) and not \
+            self.solar_system_tokens.isdisjoint(
+                SOLAR_SYSTEM_ID_PATTERN.findall(raw))
+
+    def extend_prefilter(self, corporations: typing.Iterable[int] = (),
+                         alliances: typing.Iterable[int] = (),
+                         passthrough: bool = False,
+                         solar_systems: typing.Iterable[int] = ()):
+        '''Also let packages through which mention the given corporations or
+        alliances, happened in the given systems, or every package with
+        passthrough'''
+        self._extra_corporations = frozenset(corporations)
+        self.alliance_tokens = frozenset(
+            str(alliance).encode() for alliance in alliances)
+        self.solar_system_tokens = frozenset(
+            str(system).encode() for system in solar_systems)
+        self.passthrough = passthrough
+        self._update_tokens()
+
+    async def wait_ready(self):
+        'Wait until the index has been built once'
+        await self._built.wait()
+
+    def invalidate(self):
+        'Request a rebuild as soon as possible'
+        self._invalidated.set()
+
+    def stop(self):
+        self._refresh_task.cancel()
+
+    async def rebuild(self):
+        'Rebuild the index now and swap it in atomically'
+        snapshot = self._snapshot_table()
+        corporations = frozenset(await self._builder())
+        self.corporations = corporations
+        self._update_tokens()
+        self._table_snapshot = snapshot
+        self.built_at = time.monotonic()
+        self.version += 1
+        self._built.set()
+        self.logger.info('Rebuilt relevancy index: %d corporations',
+                         len(corporations))
+
+    def _update_tokens(self):
+        self.tokens = frozenset(
+            str(corp).encode()
+            for corp in self.corporations | self._extra_corporations)
+
+    def _snapshot_table(self) -> frozenset:
+        return frozenset(
+            (entry['type'], entry['value']) for entry in self.table.all())
+
+    async def _refresh_loop(self):
+        while True:
+            self._invalidated.clear()
+            try:
+                await self.rebuild()
+                wait = self.refresh_interval
+            except Exception:
+                self.logger.exception('Failed to rebuild relevancy index')
+                wait = RETRY_INTERVAL
+
+            deadline = time.monotonic() + wait
+            while time.monotonic() < deadline:
+                try:
+                    await asyncio.wait_for(
+                        self._invalidated.wait(),
+                        min(TABLE_POLL_INTERVAL,
+                            deadline - time.monotonic()))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                if self._snapshot_table() != self._table_snapshot:
+                    self.logger.info('Relevancy table changed')
+                    break
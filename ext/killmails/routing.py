@@ -0,0 +1,148 @@
+'''
+Routing of killmails to destination channels.
+
+Rules are compiled into one hash index per dimension mapping each key to a
+bitmask of the rules naming it, plus a mask of the rules that leave the
+dimension open. Matching a killmail is a lookup per key and an AND of the
+per-dimension masks, however many rules there are.
+'''
+import bisect
+import typing
+
+
+class Route(typing.NamedTuple):
+    '''Destination channel and the conditions a killmail must meet. Empty
+    conditions match everything, entities match any involved party.'''
+    channel_id: int
+    corporations: typing.FrozenSet[int] = frozenset()
+    alliances: typing.FrozenSet[int] = frozenset()
+    regions: typing.FrozenSet[int] = frozenset()
+    ship_groups: typing.FrozenSet[int] = frozenset()
+    min_value: float = 0
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Route':
+        return cls(raw['channel_id'],
+                   frozenset(raw.get('corporations', ())),
+                   frozenset(raw.get('alliances', ())),
+                   frozenset(raw.get('regions', ())),
+                   frozenset(raw.get('ship_groups', ())),
+                   raw.get('min_value', 0))
+
+    @property
+    def has_entities(self) -> bool:
+        return bool(self.corporations or self.alliances)
+
+
+class _Index:
+    'Key -> bitmask of rules, with a mask of rules matching any key'
+
+    def __init__(self):
+        self.masks: typing.Dict[typing.Hashable, int] = {}
+        self.wildcard = 0
+
+    def add(self, bit: int, keys: typing.Iterable[typing.Hashable]):
+        for key in keys:
+            self.masks[key] = self.masks.get(key, 0) | bit
+
+    def add_condition(self, bit: int, keys: typing.Collection):
+        'Index a rule by keys, or as matching anything if there are none'
+        if keys:
+            self.add(bit, keys)
+        else:
+            self.wildcard |= bit
+
+    def match(self, keys: typing.Iterable[typing.Hashable]) -> int:
+        mask = self.wildcard
+        masks = self.masks
+        for key in keys:
+            mask |= masks.get(key, 0)
+        return mask
+
+
+class RoutingTable:
+    '''Compiled set of routes
+
+    Entity and value conditions are known as soon as a package arrives, so
+    `match_early` can skip killmails no route wants before any ESI lookups.
+    `match` then checks every condition once the region and ship group of
+    the victim's ship are known.'''
+
+    def __init__(self, routes: typing.Iterable[Route]):
+        self.routes = list(routes)
+        # Corporations and alliances are one condition, either may match
+        self._corporations = _Index()
+        self._alliances = _Index()
+        self._entity_wildcard = 0
+        self._regions = _Index()
+        self._ship_groups = _Index()
+
+        thresholds = {}
+        for position, route in enumerate(self.routes):
+            bit = 1 << position
+            if route.has_entities:
+                self._corporations.add(bit, route.corporations)
+                self._alliances.add(bit, route.alliances)
+            else:
+                self._entity_wildcard |= bit
+            self._regions.add_condition(bit, route.regions)
+            self._ship_groups.add_condition(bit, route.ship_groups)
+            thresholds[route.min_value] = \
+                thresholds.get(route.min_value, 0) | bit
+
+        # Rules with a threshold at or below each value, for bisection
+        self._thresholds = sorted(thresholds)
+        self._threshold_masks = []
+        mask = 0
+        for threshold in self._thresholds:
+            mask |= thresholds[threshold]
+            self._threshold_masks.append(mask)
+
+    def __len__(self) -> int:
+        return len(self.routes)
+
+    @classmethod
+    def from_config(cls, config: typing.List[dict]) -> 'RoutingTable':
+        return cls(map(Route.from_dict, config))
+
+    @property
+    def corporations(self) -> typing.FrozenSet[int]:
+        return frozenset(corporation_id for route in self.routes
+                         for corporation_id in route.corporations)
+
+    @property
+    def alliances(self) -> typing.FrozenSet[int]:
+        return frozenset(alliance_id for route in self.routes
+                         for alliance_id in route.alliances)
+
+    @property
+    def unrestricted(self) -> bool:
+        'Whether some route can match killmails of any corporation'
+        return any(not route.has_entities for route in self.routes)
+
+    def match_early(self, corporation_ids: typing.Iterable[int],
+                    alliance_ids: typing.Iterable[int], value: float) -> int:
+        'Bitmask of the routes whose entity and value conditions match'
+        if not self.routes:
+            return 0
+        position = bisect.bisect_right(self._thresholds, value or 0)
+        value_mask = self._threshold_masks[position - 1] if position else 0
+        entity_mask = self._entity_wildcard \
+            | self._corporations.match(corporation_ids) \
+            | self._alliances.match(alliance_ids)
+        return entity_mask & value_mask
+
+    def match(self, early_mask: int, region_id: int,
+              ship_group_id: int) -> typing.List[int]:
+        'Channel IDs of the routes matching every condition, without repeats'
+        mask = early_mask & self._regions.match((region_id, )) \
+            & self._ship_groups.match((ship_group_id, ))
+        channel_ids = []
+        while mask:
+            # Visit set bits only, lowest first
+            bit = mask & -mask
+            mask ^= bit
+            channel_id = self.routes[bit.bit_length() - 1].channel_id
+            if channel_id not in channel_ids:
+                channel_ids.append(channel_id)
+        return channel_ids
@@ -0,0 +1,341 @@
+'''
+Kill statistics cog for antinub-gregbot project.
+
+Every killmail the poster processes is appended to a columnar store of
+typed arrays, one file per column, kept sorted by kill time. Time windows
+are found by bisection, ISK totals come from running sums and per-key
+counts are taken over column slices, so leaderboards over a year of
+history answer without touching zKillboard.
+'''
+import asyncio
+import bisect
+import calendar
+import os
+import time
+import typing
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import discord.ext.commands as commands
+
+from utils.log import get_logger
+
+from .models import Package
+
+STATS_PATH = 'cache/killstats'
+SAVE_INTERVAL = 60
+LEADERBOARD_SIZE = 10
+DEFAULT_DAYS = 30
+
+LOSS = 1
+KILL = 2
+
+# Row columns and the attacker columns, which hold the relevant attackers
+# of every row back to back, delimited by attacker_offsets
+COLUMNS = {
+    'time': 'q',
+    'kill_id': 'q',
+    'value': 'd',
+    'kind': 'b',
+    'ship_type_id': 'i',
+    'solar_system_id': 'i',
+    'victim_character_id': 'q',
+    'victim_corporation_id': 'q',
+    'attacker_offsets': 'q',
+    'attacker_character_id': 'q',
+    'attacker_corporation_id': 'q',
+}
+ROW_COLUMNS = ('time', 'kill_id', 'value', 'kind', 'ship_type_id',
+               'solar_system_id', 'victim_character_id',
+               'victim_corporation_id')
+ATTACKER_COLUMNS = ('attacker_character_id', 'attacker_corporation_id')
+
+
+def setup(bot: commands.Bot):
+    bot.add_cog(KillStats(bot))
+
+
+class KillStatsStore:
+    '''Append-only columnar store of processed kills
+
+    Columns are flushed to disk every SAVE_INTERVAL seconds by appending
+    their new tail. Kills arriving out of time order, e.g. from a backfill,
+    mark the store for a re-sort before the next query, after which the
+    column files are rewritten.'''
+
+    def __init__(self, bot: commands.Bot, path: str = STATS_PATH):
+        self.logger = get_logger(__name__)
+        self.path = Path(path)
+        self.columns = {name: array(typecode)
+                        for name, typecode in COLUMNS.items()}
+        self.kill_ids = set()
+
+        self._sorted = True
+        self._rewrite = False
+        self._saved = {name: 0 for name in COLUMNS}
+        # Running sums of ISK destroyed and lost and of kills, by row
+        self._killed = array('d', [0])
+        self._lost = array('d', [0])
+        self._kills = array('q', [0])
+        self.load()
+        self._save_task = bot.loop.create_task(self._save_loop())
+
+    def __len__(self) -> int:
+        return len(self.columns['time'])
+
+    def add(self, package: Package, kind: int,
+            corporations: typing.AbstractSet[int]):
+        '''Append a kill or loss, keeping the attackers from `corporations`.
+        Kills already stored are ignored.'''
+        if package.kill_id in self.kill_ids:
+            return
+        self.kill_ids.add(package.kill_id)
+
+        killmail = package.killmail
+        victim = killmail.victim
+        row = (calendar.timegm(time.strptime(killmail.killmail_time,
+                                             '%Y-%m-%dT%H:%M:%SZ')),
+               package.kill_id, package.zkb.total_value or 0, kind,
+               victim.ship_type_id or 0, killmail.solar_system_id or 0,
+               victim.character_id or 0, victim.corporation_id or 0)
+        columns = self.columns
+        if columns['time'] and row[0] < columns['time'][-1]:
+            self._sorted = False
+        for name, value in zip(ROW_COLUMNS, row):
+            columns[name].append(value)
+
+        if kind == KILL:
+            for attacker in killmail.attackers:
+                if attacker.corporation_id in corporations:
+                    columns['attacker_character_id'].append(
+                        attacker.character_id or 0)
+                    columns['attacker_corporation_id'].append(
+                        attacker.corporation_id)
+        columns['attacker_offsets'].append(
+            len(columns['attacker_character_id']))
+
+        self._update_sums(len(self) - 1)
+
+    def window(self, start: float,
+               end: float = None) -> typing.Tuple[int, int]:
+        'Row range of the kills between two UNIX times'
+        self._ensure_sorted()
+        times = self.columns['time']
+        low = bisect.bisect_left(times, start)
+        high = len(times) if end is None else bisect.bisect_right(times, end)
+        return low, high
+
+    def isk(self, low: int, high: int) -> typing.Tuple[float, float]:
+        'ISK destroyed and lost in a row range'
+        return (self._killed[high] - self._killed[low],
+                self._lost[high] - self._lost[low])
+
+    def counts(self, low: int, high: int) -> typing.Tuple[int, int]:
+        'Number of kills and losses in a row range'
+        kills = self._kills[high] - self._kills[low]
+        return kills, high - low - kills
+
+    def top_killers(self, low: int, high: int,
+                    count: int = LEADERBOARD_SIZE) -> list:
+        'Characters on the most kills in a row range'
+        offsets = self.columns['attacker_offsets']
+        first = offsets[low - 1] if low else 0
+        last = offsets[high - 1] if high else 0
+        counter = Counter(self.columns['attacker_character_id'][first:last])
+        del counter[0]
+        return counter.most_common(count)
+
+    def top_systems(self, low: int, high: int,
+                    count: int = LEADERBOARD_SIZE) -> list:
+        'Solar systems with the most kills and losses in a row range'
+        counter = Counter(self.columns['solar_system_id'][low:high])
+        del counter[0]
+        return counter.most_common(count)
+
+    def load(self):
+        for name, column in self.columns.items():
+            path = self.path / (name + '.bin')
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            # Drop a partial item left by an interrupted write
+            column.frombytes(data[:len(data) - len(data) % column.itemsize])
+
+        # Trim rows to the shortest row column, in case a save was cut off
+        rows = min(len(self.columns[name]) for name in ROW_COLUMNS
+                   + ('attacker_offsets', ))
+        for name in ROW_COLUMNS + ('attacker_offsets', ):
+            del self.columns[name][rows:]
+        attackers = self.columns['attacker_offsets'][-1] if rows else 0
+        for name in ATTACKER_COLUMNS:
+            del self.columns[name][attackers:]
+
+        self._saved = {name: len(column)
+                       for name, column in self.columns.items()}
+        self.kill_ids = set(self.columns['kill_id'])
+        times = self.columns['time']
+        self._sorted = all(times[i] <= times[i + 1]
+                           for i in range(len(times) - 1))
+        self._rebuild_sums()
+        if rows:
+            self.logger.info('Loaded %d kills', rows)
+
+    def save(self):
+        'Append new column tails to disk, or rewrite them after a re-sort'
+        self.path.mkdir(parents=True, exist_ok=True)
+        for name, column in self.columns.items():
+            path = self.path / (name + '.bin')
+            if self._rewrite:
+                tmp_path = path.with_suffix('.tmp')
+                with open(tmp_path, 'wb') as f:
+                    column.tofile(f)
+                os.replace(str(tmp_path), str(path))
+            elif len(column) > self._saved[name]:
+                with open(path, 'ab') as f:
+                    column[self._saved[name]:].tofile(f)
+            self._saved[name] = len(column)
+        self._rewrite = False
+
+    def stop(self):
+        self._save_task.cancel()
+        self.save()
+
+    def _rebuild_sums(self):
+        del self._killed[1:]
+        del self._lost[1:]
+        del self._kills[1:]
+        for row in range(len(self)):
+            self._update_sums(row)
+
+    def _update_sums(self, row: int):
+        value = self.columns['value'][row]
+        is_kill = self.columns['kind'][row] == KILL
+        self._killed.append(self._killed[-1] + (value if is_kill else 0))
+        self._lost.append(self._lost[-1] + (0 if is_kill else value))
+        self._kills.append(self._kills[-1] + is_kill)
+
+    def _ensure_sorted(self):
+        if self._sorted:
+            return
+        columns = self.columns
+        order = sorted(range(len(self)), key=columns['time'].__getitem__)
+
+        # Rebuild the attacker columns in the new row order
+        offsets = columns['attacker_offsets']
+        attacker_columns = {name: array(COLUMNS[name])
+                            for name in ATTACKER_COLUMNS}
+        new_offsets = array('q')
+        for row in order:
+            first = offsets[row - 1] if row else 0
+            for name in ATTACKER_COLUMNS:
+                attacker_columns[name].extend(
+                    columns[name][first:offsets[row]])
+            new_offsets.append(len(attacker_columns[ATTACKER_COLUMNS[0]]))
+
+        for name in ROW_COLUMNS:
+            column = columns[name]
+            columns[name] = array(column.typecode,
+                                  map(column.__getitem__, order))
+        columns['attacker_offsets'] = new_offsets
+        columns.update(attacker_columns)
+
+        self._sorted = True
+        self._rewrite = True
+        self._rebuild_sums()
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            try:
+                self.save()
+            except OSError:
+                self.logger.exception('Failed to save kill statistics')
+
+
+class KillStats(commands.Cog, name='KillStats'):
+    '''Leaderboards over the kills posted by the killmail poster'''
+
+    def __init__(self, bot: commands.Bot):
+        self.logger = get_logger(__name__)
+        self.bot = bot
+
+    @property
+    def poster(self):
+        poster = self.bot.get_cog('KillmailPoster')
+        if poster is None:
+            raise commands.CommandError('KillmailPoster is not loaded')
+        return poster
+
+    def get_window(self, start: str, end: str = None
+                   ) -> typing.Tuple[int, int, str]:
+        '''Row range and description of a window given as a number of days
+        back from now, or as a start and an optional end date (YYYY-MM-DD)'''
+        if end is None and start.isdigit():
+            low, high = self.poster.stats.window(
+                time.time() - int(start) * 86400)
+            return low, high, 'last {} days'.format(start)
+
+        try:
+            start_time = datetime.strptime(start, '%Y-%m-%d')
+            # The end date is inclusive
+            end_time = datetime.strptime(end, '%Y-%m-%d') \
+                + timedelta(days=1, seconds=-1) if end else datetime.utcnow()
+        except ValueError:
+            raise commands.BadArgument(
+                'Give a number of days or dates as YYYY-MM-DD') from None
+        low, high = self.poster.stats.window(
+            calendar.timegm(start_time.timetuple()),
+            calendar.timegm(end_time.timetuple()))
+        return low, high, '{:%Y-%m-%d} to {:%Y-%m-%d}'.format(start_time,
+                                                              end_time)
+
+    @commands.group(invoke_without_command=True)
+    async def killstats(self, ctx, start: str = str(DEFAULT_DAYS),
+                        end: str = None):
+        '''ISK destroyed and lost over the last days or between two dates
+        (YYYY-MM-DD)'''
+        low, high, description = self.get_window(start, end)
+        stats = self.poster.stats
+        killed, lost = stats.isk(low, high)
+        kills, losses = stats.counts(low, high)
+        efficiency = killed / (killed + lost) if killed + lost else 0
+        await ctx.send(
+            '{}: {:,} kills worth {:,.0f} ISK, {:,} losses worth '
+            '{:,.0f} ISK ({:.1%} efficiency)'.format(
+                description.capitalize(), kills, killed, losses, lost,
+                efficiency))
+
+    @killstats.command()
+    async def killers(self, ctx, start: str = str(DEFAULT_DAYS),
+                      end: str = None):
+        'Pilots on the most kills over the last days or between two dates'
+        low, high, description = self.get_window(start, end)
+        await self.send_leaderboard(
+            ctx, 'Top killers, ' + description,
+            self.poster.stats.top_killers(low, high))
+
+    @killstats.command()
+    async def systems(self, ctx, start: str = str(DEFAULT_DAYS),
+                      end: str = None):
+        '''Systems with the most kills and losses over the last days or
+        between two dates'''
+        low, high, description = self.get_window(start, end)
+        await self.send_leaderboard(
+            ctx, 'Busiest systems, ' + description,
+            self.poster.stats.top_systems(low, high))
+
+    async def send_leaderboard(self, ctx, title: str, leaderboard: list):
+        if not leaderboard:
+            await ctx.send('{}: nothing recorded'.format(title))
+            return
+        names = await self.poster.resolve_names(
+            self.bot.loop, [entity_id for entity_id, _ in leaderboard])
+        lines = ['{:>2}. {} ({:,})'.format(
+            position, names.get(entity_id) or entity_id, count)
+                 for position, (entity_id, count)
+                 in enumerate(leaderboard, 1)]
+        await ctx.send('{}:\n```\n{}\n```'.format(title, '\n'.join(lines)))
@@ -0,0 +1,175 @@
+'''
+Write-ahead log of accepted killmails.
+
+Packages are appended once the pipeline accepts them and marked done once
+they are ignored or their message is sent, so killmails queued or in flight
+when the bot stops are posted on the next start. Records are JSON lines in
+numbered segment files. Appends only write to a buffer; a background task
+fsyncs in batches, rotates full segments and deletes the oldest segments
+once nothing in them is pending.
+'''
+import asyncio
+import json
+import os
+import typing
+from pathlib import Path
+
+from utils.log import get_logger
+
+WAL_PATH = 'cache/killmail-wal'
+SEGMENT_SIZE = 4 * 1024 * 1024
+SYNC_INTERVAL = 0.2
+MAX_ATTEMPTS = 3
+SEGMENT_SUFFIX = '.log'
+
+
+class WriteAheadLog:
+    '''Append-only log of entries keyed by kill ID
+
+    Entries still pending from a previous run are available as `recovered`
+    after construction. They have been carried over into a fresh segment
+    with their attempt count raised, and entries that already had
+    MAX_ATTEMPTS attempts are dropped.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, path: str = WAL_PATH,
+                 segment_size: int = SEGMENT_SIZE,
+                 sync_interval: float = SYNC_INTERVAL):
+        self.logger = get_logger(__name__)
+        self.loop = loop
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.appended = 0
+        self.syncs = 0
+
+        # Pending kill IDs per segment, the segment holding each of them and
+        # their attempt counts
+        self._segments: typing.Dict[int, set] = {}
+        self._locations: typing.Dict[int, int] = {}
+        self._attempts: typing.Dict[int, int] = {}
+        self._dirty = False
+
+        self.recovered = self._recover()
+        old_segments = self._list_segments()
+        self._open_segment(old_segments[-1] + 1 if old_segments else 0)
+        for entry in self.recovered:
+            self.append(entry['id'], entry['value'], entry['attempts'])
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        for segment in old_segments:
+            os.remove(str(self._segment_path(segment)))
+
+        self._sync_task = loop.create_task(self._sync_loop())
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def append(self, kill_id: int, value: dict, attempts: int = None):
+        '''Log value as pending for kill_id, synced to disk in the next batch.
+        attempts defaults to that of the entry already pending for kill_id,
+        or 1 for a new entry.'''
+        if attempts is None:
+            attempts = self._attempts.get(kill_id, 1)
+        self._write({'op': 'add', 'id': kill_id, 'value': value,
+                     'attempts': attempts})
+        previous = self._locations.get(kill_id)
+        if previous is not None:
+            self._segments[previous].discard(kill_id)
+        self._locations[kill_id] = self._segment
+        self._attempts[kill_id] = attempts
+        self._segments[self._segment].add(kill_id)
+        self.appended += 1
+
+    def done(self, kill_id: int):
+        'Mark the entry for kill_id as done'
+        segment = self._locations.pop(kill_id, None)
+        self._attempts.pop(kill_id, None)
+        if segment is None or self._file.closed:
+            return
+        self._segments[segment].discard(kill_id)
+        self._write({'op': 'done', 'id': kill_id})
+
+    def stop(self):
+        self._sync_task.cancel()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._dirty = True
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.path / '{:08d}{}'.format(segment, SEGMENT_SUFFIX)
+
+    def _list_segments(self) -> typing.List[int]:
+        return sorted(int(path.stem) for path in
+                      self.path.glob('*' + SEGMENT_SUFFIX))
+
+    def _open_segment(self, segment: int):
+        self._segment = segment
+        self._segments[segment] = set()
+        self._file = open(str(self._segment_path(segment)), 'a',
+                          encoding='utf-8')
+
+    def _recover(self) -> typing.List[dict]:
+        'Read the entries left pending by a previous run, oldest first'
+        pending = {}
+        for segment in self._list_segments():
+            with open(str(self._segment_path(segment)), 'r',
+                      encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of a segment
+                        self.logger.warning('Skipping corrupt record in '
+                                            'WAL segment %d', segment)
+                        continue
+                    if record['op'] == 'add':
+                        pending[record['id']] = record
+                    else:
+                        pending.pop(record['id'], None)
+
+        recovered = []
+        for record in pending.values():
+            if record['attempts'] >= MAX_ATTEMPTS:
+                self.logger.warning('Dropping killmail %d after %d attempts',
+                                    record['id'], record['attempts'])
+                continue
+            recovered.append({'id': record['id'], 'value': record['value'],
+                              'attempts': record['attempts'] + 1})
+        if recovered:
+            self.logger.info('Recovered %d pending killmails', len(recovered))
+        return recovered
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self._sync()
+            except OSError:
+                self.logger.exception('Failed to sync the WAL')
+
+    async def _sync(self):
+        if self._dirty:
+            self._dirty = False
+            self._file.flush()
+            await self.loop.run_in_executor(None, os.fsync,
+                                            self._file.fileno())
+            self.syncs += 1
+
+        # Rotation and cleanup only happen here, never during an fsync
+        if self._file.tell() >= self.segment_size:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._open_segment(self._segment + 1)
+        # Only delete from the oldest segment on, as a later segment holds
+        # the done records of entries added to earlier, still live ones
+        for segment in sorted(self._segments):
+            if self._segments[segment] or segment == self._segment:
+                break
+            del self._segments[segment]
+            os.remove(str(self._segment_path(segment)))
@@ -1,15 +1,30 @@
+import hashlib
 import logging
+import re
+from collections import Counter
 from datetime import datetime
 
 from discord.embeds import Embed
 from discord.ext import commands
 from utils.log import get_logger
 from utils.messaging import Paginate, notify_owner
+from utils.sendqueue import PING, get_send_scheduler
 from utils.checks import is_owner_private_channel
+from utils.colourthief import get_colour_service
+from utils.expiringset import ExpiringSet
 
 from .discordrelay import DiscordRelay
 from .jabberrelay import JabberRelay
 
+DEDUP_SIZE = 1000
+DEDUP_WINDOW = 600
+# Embeds are relayed as text between two rows of '=', see DiscordRelay
+EMBED_BLOCK_PATTERN = re.compile(r'={20}\n(.*?)={20}', re.DOTALL)
+# Also matches @everyone and @here as escaped with a zero width space by
+# discord's clean_content
+MENTION_PATTERN = re.compile(r'@\u200b?(?:everyone|here)|<(?:@[!&]?|#)\d+>')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
 
 def setup(bot: commands.Bot):
     bot.add_cog(PingAggregator(bot))
@@ -24,7 +39,11 @@ class PingAggregator(commands.Cog, name='PingAggregator'):
         self.bot = bot
         bot.add_listener(self.on_broadcast)
         self.relays = []
-        self.create_clients(bot.ext_config['pings'])
+        config = bot.ext_config['pings']
+        self.seen = ExpiringSet(config.get('dedup_size', DEDUP_SIZE),
+                                config.get('dedup_window', DEDUP_WINDOW))
+        self.duplicates = Counter()
+        self.create_clients(config)
 
     def create_clients(self, config):
         'Creates an JabberRelay client for each server specified'
@@ -35,10 +54,31 @@ class PingAggregator(commands.Cog, name='PingAggregator'):
             discord_config['default_icon_url'] = config['default_icon_url']
             self.relays.append(DiscordRelay(self.bot, discord_config))
 
+    @staticmethod
+    def fingerprint(body):
+        '''Hash of the ping text ignoring whitespace, mentions and case, so
+        copies arriving through different relays match. Relayed embeds count
+        by their contents. None if no text is left, e.g. for a bare mention,
+        as such pings cannot be told apart.'''
+        text = EMBED_BLOCK_PATTERN.sub(r' \1 ', body)
+        text = WHITESPACE_PATTERN.sub(' ', MENTION_PATTERN.sub(' ', text))
+        text = text.strip().casefold()
+        if not text:
+            return None
+        return hashlib.sha1(text.encode()).digest()
+
     async def on_broadcast(self, package):
         'Relay message to discord, ignore if it is a duplicate'
         body = package['body']
 
+        # DiscordRelay bodies have their mentions resolved to names, the raw
+        # body keeps them in a form fingerprint can strip
+        fingerprint = self.fingerprint(package.get('raw_body', body))
+        if fingerprint is not None and not self.seen.add(fingerprint):
+            self.duplicates[package['description']] += 1
+            self.logger.info('Ignored duplicate message from %s (%s)',
+                             package['sender'], package['description'])
+            return
         self.logger.info('Relaying message from %s', package['sender'])
 
         embeds = []
@@ -46,6 +86,7 @@ class PingAggregator(commands.Cog, name='PingAggregator'):
         for page in paginate:
             embed = self.ping_embed(package, page, paginate)
             embeds.append(embed)
+        scheduler = get_send_scheduler(self.bot.loop)
         for destination in package['destinations']:
             channel_id = destination['channel_id']
             channel = self.bot.get_channel(channel_id)
@@ -53,9 +94,11 @@ class PingAggregator(commands.Cog, name='PingAggregator'):
             if channel:
                 embed = embeds[0]
                 # Only show prefix on first page.
-                await channel.send(embed=embed, content=destination.get('prefix'))
+                await scheduler.send_message(
+                    PING, channel, embed=embed,
+                    content=destination.get('prefix'))
                 for embed in embeds[1:]:
-                    await channel.send(embed=embed)
+                    await scheduler.send_message(PING, channel, embed=embed)
             else:
                 await notify_owner(self.bot,
                                    ['Invalid channel: {}'.format(channel_id)])
@@ -78,6 +121,10 @@ class PingAggregator(commands.Cog, name='PingAggregator'):
 
         else:
             response = 'No relays initialised.'
+        if self.duplicates:
+            response += '\nDuplicates ignored: {}'.format(', '.join(
+                '{} from {}'.format(count, source)
+                for source, count in self.duplicates.most_common()))
         return await ctx.send(response)
 
     @staticmethod
@@ -101,6 +148,7 @@ class PingAggregator(commands.Cog, name='PingAggregator'):
 
         return embed
 
-    def __unload(self):
+    def cog_unload(self):
         for relay in self.relays:
             relay.disconnect()
+        get_colour_service(self.bot.loop).stop()
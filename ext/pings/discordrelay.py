@@ -1,8 +1,6 @@
-import itertools
-
 from discordself import Client, Status
 
-from utils.colourthief import get_embed_colour
+from utils.colourthief import get_colour_service
 from utils.log import get_logger
 from utils.messaging import notify_owner
 from discordself.ext import commands
@@ -16,7 +14,8 @@ class DiscordRelay(commands.Cog, name='DiscordRelay'):
         self.client = Client(loop=bot.loop)
         self.client.event(self.on_ready)
         self.client.event(self.on_message)
-        self._embed_colour_cache = {}
+        self.colours = get_colour_service(bot.loop)
+        self.compile_routes(config['routes'])
         bot.loop.create_task(self.client.start(config["token"]))
 
     def disconnect(self):
@@ -43,16 +42,37 @@ class DiscordRelay(commands.Cog, name='DiscordRelay'):
 
         return self.config['default_icon_url']
 
-    def get_cached_embed_colour(self, url):
+    def compile_routes(self, routes):
         '''
-        Stores colourthief output locally for reuse
+        Indexes the .yaml route config by source guild and channel, so routing a message
+        is a few dict lookups however many routes there are
         '''
-        if url in self._embed_colour_cache:
-            return self._embed_colour_cache[url]
-
-        colour = get_embed_colour(url)
-        self._embed_colour_cache[url] = colour
-        return colour
+        self._guild_routes = {}
+        self._channel_routes = {}
+        self._ignored_channels = []
+        self._route_destinations = []
+        self._catch_all_destinations = []
+        for index, route in enumerate(routes):
+            # Routes without sources are catch-alls for otherwise unrouted messages
+            if 'from_guilds' not in route and 'from_channels' not in route:
+                self._catch_all_destinations.extend(route['destinations'])
+            for guild in route.get('from_guilds', ()):
+                self._guild_routes.setdefault(guild, []).append(index)
+            for channel in route.get('from_channels', ()):
+                self._channel_routes.setdefault(channel, []).append(index)
+            self._ignored_channels.append(frozenset(route.get('ignore_channels', ())))
+            self._route_destinations.append(route['destinations'])
+
+    def is_watched(self, message):
+        '''
+        Cheap check whether any route can apply to the message, to drop noise before doing
+        any other work
+        '''
+        if message.guild is None:
+            return False
+        return bool(self._catch_all_destinations) or \
+            message.guild.id in self._guild_routes or \
+            message.channel.id in self._channel_routes
 
     def route_message(self, message):
         '''
@@ -61,21 +81,17 @@ class DiscordRelay(commands.Cog, name='DiscordRelay'):
         guild = message.guild.id
         channel = message.channel.id
         destinations = []
-        # Attempt to apply routing rules based on guild and channel ids
-        for route in self.config['routes']:
-            if 'from_guilds' in route and guild in route['from_guilds'] or\
-            'from_channels' in route and channel in route['from_channels']:
-                # Make sure the source channel is not in the ignore_channels list
-                if not ('ignore_channels' in route and channel in route['ignore_channels']):
-                    destinations.extend(route['destinations'])
+        # Attempt to apply routing rules based on guild and channel ids, in config order
+        routes = set(self._guild_routes.get(guild, ()))
+        routes.update(self._channel_routes.get(channel, ()))
+        for index in sorted(routes):
+            # Make sure the source channel is not in the ignore_channels list
+            if channel not in self._ignored_channels[index]:
+                destinations.extend(self._route_destinations[index])
 
         # If no destinations were found, route to catch-all destinations
         if len(destinations) == 0:
-            default_routes = filter(\
-                lambda route: 'from_guilds' not in route and 'from_channels' not in route, \
-                self.config['routes'])
-            default_destinations = map(lambda x: x['destinations'], default_routes)
-            destinations = list(itertools.chain.from_iterable(default_destinations))
+            destinations = list(self._catch_all_destinations)
 
         self.logger.debug('Routed message from guild {} ({}) channel {} ({}) to destinations {}'\
             .format(message.guild.name, message.guild.id, message.channel.name, message.channel.id,\
@@ -108,17 +124,28 @@ class DiscordRelay(commands.Cog, name='DiscordRelay'):
 
     async def on_ready(self):
         await self.client.change_presence(status=Status.invisible)
+        # Pick the colours of watched guilds' logos before their first ping
+        self.colours.warm(
+            str(guild.icon_url) if guild.icon else self.config['default_icon_url']
+            for guild in self.client.guilds
+            if self._catch_all_destinations or guild.id in self._guild_routes or
+            any(channel.id in self._channel_routes for channel in guild.channels))
 
     async def on_message(self, message):
-        if message.mention_everyone:
+        if message.mention_everyone and self.is_watched(message):
             message_logo = self.get_message_logo(message)
             content = message.clean_content
+            # Mentions stay in their raw <@id> form for deduplication
+            raw_content = message.content
             for embed in message.embeds:
                 self.logger.debug('Converting embed for message_id={} to string {}'\
                     .format(message.id, str(embed)))
-                content += '\n\n' + self.stringify_embed(embed)
+                embed_content = '\n\n' + self.stringify_embed(embed)
+                content += embed_content
+                raw_content += embed_content
             package = {
                 'body': content,
+                'raw_body': raw_content,
                 'sender': message.author.display_name,
                 'destinations': self.route_message(message),
                 'description': '{}: {}'.format(
@@ -126,6 +153,6 @@ class DiscordRelay(commands.Cog, name='DiscordRelay'):
                     message.channel.name or "Private Channel"
                 ),
                 'logo_url': message_logo,
-                'embed_colour': self.get_cached_embed_colour(message_logo)
+                'embed_colour': await self.colours.get_colour(message_logo)
             }
             self.bot.dispatch('broadcast', package)
@@ -9,7 +9,7 @@ they are sent by a jid in the config.JABBER_SERVERS['relay_from'] list
 import aioxmpp
 from aioxmpp.structs import LanguageRange
 
-from utils.colourthief import get_embed_colour
+from utils.colourthief import FALLBACK_COLOUR, get_colour_service
 
 
 class JabberRelay(aioxmpp.PresenceManagedClient):
@@ -37,7 +37,9 @@ class JabberRelay(aioxmpp.PresenceManagedClient):
         self.bot = bot
         self.relay_from = jabber_server['relay_from']
         self.jabber_server = jabber_server
-        self.embed_colour = get_embed_colour(jabber_server['logo_url'])
+        # Start with the fallback colour until the logo's has been picked
+        self.embed_colour = FALLBACK_COLOUR
+        bot.loop.create_task(self.update_embed_colour())
         self.languages = [LanguageRange(tag='en'), LanguageRange.WILDCARD]
         self.summon(aioxmpp.DiscoServer)
         self.summon(aioxmpp.RosterClient)
@@ -53,6 +55,11 @@ class JabberRelay(aioxmpp.PresenceManagedClient):
 
         self.presence = aioxmpp.PresenceState(True, aioxmpp.PresenceShow.AWAY)
 
+    async def update_embed_colour(self):
+        colours = get_colour_service(self.bot.loop)
+        self.embed_colour = await colours.get_colour(
+            self.jabber_server['logo_url'], timeout=None)
+
     def disconnect(self):
         self.presence = aioxmpp.PresenceState(False)
 
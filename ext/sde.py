@@ -0,0 +1,83 @@
+"""
+Cog managing the offline EVE static data export used instead of ESI for
+universe and type lookups
+"""
+from datetime import datetime
+
+import discord.ext.commands as commands
+
+import utils.checks as checks
+from utils.log import get_logger
+from utils.sde import (SDE_PATH, get_remote_version, get_static_data,
+                       import_sde)
+
+
+def setup(bot):
+    "Adds the cog to the provided discord bot"
+    bot.add_cog(StaticDataExport(bot))
+
+
+class StaticDataExport(commands.Cog, name="SDE"):
+    def __init__(self, bot):
+        self.logger = get_logger(__name__)
+        self.bot = bot
+        # Shared with the killmail poster, which picks up the reload
+        config = (bot.ext_config or {}).get('killmails', {})
+        self.path = config.get('sde_path', SDE_PATH)
+        self.static_data = get_static_data(self.path)
+        self.importing = False
+
+    def get_health(self):
+        'Returns a string describing the status of this cog'
+        if self.static_data.available:
+            return '\n  \u2714 SDE version {} loaded'.format(
+                self.static_data.version)
+
+        return '\n  \u2716 No SDE imported, static data comes from ESI'
+
+    @commands.group()
+    @commands.check(checks.is_owner)
+    async def sde(self, ctx):
+        'Group of commands managing the offline static data export'
+        if not ctx.invoked_subcommand:
+            await ctx.send('Usage: {}sde [version | import]'.format(
+                ctx.prefix))
+
+    @sde.command()
+    async def version(self, ctx):
+        'Compare the imported SDE with the latest published one'
+        remote = await self.bot.loop.run_in_executor(None, get_remote_version)
+        local = self.static_data.version
+        if local is None:
+            response = 'No SDE imported. Latest version: `{}`'.format(remote)
+        elif local == remote:
+            imported_at = datetime.utcfromtimestamp(
+                int(self.static_data.meta['imported_at']))
+            response = 'SDE `{}` is up to date (imported {:%Y-%m-%d %H:%M})' \
+                .format(local, imported_at)
+        else:
+            response = 'SDE `{}` is outdated, latest version: `{}`'.format(
+                local, remote)
+        await ctx.send(response)
+
+    @sde.command(name='import')
+    async def sde_import(self, ctx):
+        'Download the latest SDE and rebuild the local database'
+        if self.importing:
+            await ctx.send('An import is already running')
+            return
+
+        self.importing = True
+        await ctx.send('Importing SDE, this can take a few minutes...')
+        try:
+            version = await self.bot.loop.run_in_executor(
+                None, import_sde, self.path)
+        except Exception as exception:
+            self.logger.exception('Failed to import SDE')
+            await ctx.send('Failed to import SDE: `{}`'.format(exception))
+            return
+        finally:
+            self.importing = False
+
+        self.static_data.reload()
+        await ctx.send('Imported SDE version `{}`'.format(version))
@@ -0,0 +1,105 @@
+'''
+Benchmark of the embed colour extraction.
+
+Times SaturatedColourThief against the per-pixel implementation it
+replaced, on the given images or on generated ones, and reports whether
+both pick the same colour.
+
+Usage:
+    python -m tools.colour_benchmark
+    python -m tools.colour_benchmark logo.png icon.png --repeat 5
+'''
+import argparse
+import io
+import random
+import time
+
+from colorthief import ColorThief, MMCQ
+from PIL import Image, ImageDraw
+
+from utils.colourthief import SaturatedColourThief, is_saturated
+
+GENERATED_SIZES = (128, 512, 1024)
+
+
+class PerPixelColourThief(ColorThief):
+    'The previous implementation, walking every pixel in Python'
+
+    def get_palette(self, color_count=10, quality=10):
+        image = self.image.convert('RGBA')
+        pixels = image.getdata()
+        valid_pixels = [pixel[:3] for pixel in
+                        (pixels[i] for i in range(0, len(pixels), quality))
+                        if pixel[3] >= 125 and is_saturated(*pixel[:3])]
+        if not valid_pixels:
+            return super(PerPixelColourThief, self).get_palette(
+                color_count, quality)
+        return MMCQ.quantize(valid_pixels, color_count).palette
+
+
+def generate_image(size: int, seed: int) -> bytes:
+    'A logo-like image: transparent corners, shapes and a gradient'
+    rng = random.Random(seed)
+    image = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((0, 0, size - 1, size - 1), fill=(20, 20, 30, 255))
+    for _ in range(12):
+        x, y = rng.randrange(size), rng.randrange(size)
+        radius = rng.randrange(size // 16, size // 4)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+                     fill=(rng.randrange(256), rng.randrange(256),
+                           rng.randrange(256), 255))
+    for row in range(size):
+        draw.line((0, row, size // 3, row),
+                  fill=(row * 255 // size, 80, 160, 255))
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+def measure(cls, data: bytes, repeat: int):
+    'Best time of repeat runs and the colour picked'
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        colour = cls(io.BytesIO(data)).get_palette(5, 1)[0]
+        best = min(best, time.perf_counter() - started)
+    return best, colour
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('images', nargs='*',
+                        help='image files, generated images if none')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.images:
+        images = []
+        for path in args.images:
+            with open(path, 'rb') as f:
+                images.append((path, f.read()))
+    else:
+        images = [('generated {0}x{0}'.format(size),
+                   generate_image(size, size))
+                  for size in GENERATED_SIZES]
+
+    print('{:<24} {:>12} {:>12} {:>8}  {}'.format(
+        'image', 'per pixel', 'current', 'speedup', 'colours'))
+    for name, data in images:
+        old_time, old_colour = measure(PerPixelColourThief, data,
+                                       args.repeat)
+        new_time, new_colour = measure(SaturatedColourThief, data,
+                                       args.repeat)
+        distance = max(abs(old - new)
+                       for old, new in zip(old_colour, new_colour))
+        print('{:<24} {:>10.1f}ms {:>10.1f}ms {:>7.1f}x  {} {} ({})'.format(
+            name, old_time * 1000, new_time * 1000, old_time / new_time,
+            '#{:02x}{:02x}{:02x}'.format(*old_colour),
+            '#{:02x}{:02x}{:02x}'.format(*new_colour),
+            'identical' if not distance
+            else 'channels within {}'.format(distance)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+'''
+Record/replay load harness for the killmail pipeline.
+
+Records raw RedisQ packages to a gzip-compressed JSONL capture, and replays
+captures through the real RedisQListener and KillmailPoster with local
+stand-ins for ESI and the Discord API, reporting throughput, time-to-post
+percentiles and call counts.
+
+Usage:
+    python -m tools.killmail_harness record capture.jsonl.gz --count 1000
+    python -m tools.killmail_harness replay capture.jsonl.gz --speed 10 \\
+        --corporation 98000001 --alliance 99000001
+'''
+import argparse
+import asyncio
+import io
+import json
+import logging
+import re
+import sys
+import tempfile
+import time
+import types
+from collections import Counter
+from pathlib import Path
+
+import aiohttp
+import tinydb
+from tinydb.storages import MemoryStorage
+
+from ext.killmails import listener, poster
+from ext.killmails.cards import ICON_URL
+from ext.killmails.recording import PackageRecorder, read_recording
+from utils import sendqueue
+from utils.esicache import EsiCache
+from utils.kvtable import KeyValueTable
+from utils.sendqueue import percentile
+
+CHANNEL_ID = 1
+KILL_ID_PATTERN = re.compile(rb'"killID"\s*:\s*(\d+)')
+ZKILLBOARD_URL_PATTERN = re.compile(r'/kill/(\d+)/')
+
+
+class FakeEsiApp:
+    '''Stands in for the esipy App, operations are (name, params) pairs'''
+
+    class _Operations:
+        def __getitem__(self, name):
+            return lambda **params: (name, params)
+
+    op = _Operations()
+
+
+class FakeEsiResponse:
+    def __init__(self, data):
+        self.status = 200
+        self.data = data
+        self.raw = json.dumps(data).encode()
+        self.header = {}
+
+
+class FakeEsiClient:
+    '''Answers ESI operations with synthetic data after a fixed latency'''
+
+    def __init__(self, latency: float, alliance_corporations: dict):
+        self.latency = latency
+        self.alliance_corporations = alliance_corporations
+        self.calls = Counter()
+
+    async def request(self, req_and_resp):
+        name, params = req_and_resp
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+        return FakeEsiResponse(self._respond(name, params))
+
+    async def close(self):
+        pass
+
+    def _respond(self, name, params):
+        if name == 'get_universe_systems_system_id':
+            system_id = params['system_id']
+            return {
+                'system_id': system_id,
+                'name': 'System {}'.format(system_id),
+                'constellation_id': 20000000 + system_id % 1000
+            }
+        if name == 'get_universe_constellations_constellation_id':
+            constellation_id = params['constellation_id']
+            return {
+                'constellation_id': constellation_id,
+                'name': 'Constellation {}'.format(constellation_id),
+                'region_id': 10000000 + constellation_id % 100
+            }
+        if name == 'get_universe_regions_region_id':
+            return {
+                'region_id': params['region_id'],
+                'name': 'Region {}'.format(params['region_id'])
+            }
+        if name == 'get_universe_types_type_id':
+            return {
+                'type_id': params['type_id'],
+                'name': 'Type {}'.format(params['type_id']),
+                'dogma_attributes': [{'attribute_id': 1137, 'value': 3}]
+            }
+        if name == 'post_universe_names':
+            return [{
+                'id': entity_id,
+                'name': 'Entity {}'.format(entity_id),
+                'category': 'character'
+            } for entity_id in params['ids']]
+        if name == 'get_alliances_alliance_id_corporations':
+            return sorted(
+                self.alliance_corporations.get(params['alliance_id'], ()))
+        raise KeyError('No stand-in for ESI operation {}'.format(name))
+
+
+class ReplayResponse:
+    def __init__(self, raw: bytes):
+        self.raw = raw
+
+    def raise_for_status(self):
+        pass
+
+    async def read(self):
+        return self.raw
+
+
+class IconResponse:
+    'Stands in for the image server, serving a blank icon for every type'
+    _icon: bytes = None
+
+    def raise_for_status(self):
+        pass
+
+    async def read(self):
+        if IconResponse._icon is None:
+            from PIL import Image
+            output = io.BytesIO()
+            Image.new('RGBA', (64, 64), (96, 96, 96, 255)).save(output, 'PNG')
+            IconResponse._icon = output.getvalue()
+        return IconResponse._icon
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *dummy_args):
+        return False
+
+
+class ReplaySession:
+    '''Stands in for the aiohttp session the listener long-polls with,
+    serving captured bodies at the capture's pace divided by speed'''
+
+    def __init__(self, entries, speed: float):
+        self.entries = entries
+        self.speed = speed
+        self.received = {}
+        self.replayed = 0
+        self.exhausted = asyncio.Event()
+        self._start = None
+        self._first = None
+
+    def get(self, url, **_kwargs):
+        if url.startswith(ICON_URL.split('{')[0]):
+            return IconResponse()
+        return self
+
+    async def __aenter__(self):
+        try:
+            received, raw = next(self.entries)
+        except StopIteration:
+            self.exhausted.set()
+            await asyncio.Event().wait()  # Long-poll forever
+
+        now = time.monotonic()
+        if self._start is None:
+            self._start, self._first = now, received
+        if self.speed:
+            delay = self._start + (received - self._first) / self.speed - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        match = KILL_ID_PATTERN.search(raw)
+        if match:
+            self.received[int(match.group(1))] = time.monotonic()
+        self.replayed += 1
+        return ReplayResponse(raw)
+
+    async def __aexit__(self, *dummy_args):
+        return False
+
+
+class HarnessBot:
+    '''Just enough of commands.Bot for the killmail cogs, with Discord
+    calls answered locally after a fixed latency'''
+
+    def __init__(self, loop, session, config, discord_latency: float):
+        self.loop = loop
+        self.ext_config = {'killmails': config}
+        self.user = types.SimpleNamespace(id=0)
+        self.http = types.SimpleNamespace(session=session)
+        self.tdb = tinydb.TinyDB(storage=MemoryStorage)
+        self.cogs = {}
+        self.discord_latency = discord_latency
+        self.discord_calls = Counter()
+        self.posted = {}
+        self.errors = 0
+        self._channels = {}
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def get_channel(self, channel_id):
+        if channel_id not in self._channels:
+            self._channels[channel_id] = HarnessChannel(self, channel_id)
+        return self._channels[channel_id]
+
+    def dispatch(self, *dummy_args, **dummy_kwargs):
+        pass
+
+    async def on_error(self, event, *_args, **kwargs):
+        self.errors += 1
+        logging.getLogger(__name__).exception('Error in %s %s', event,
+                                              kwargs.get('debug_info', ''))
+
+    async def send_embeds(self, channel, embeds, **_kwargs):
+        self.discord_calls['send_message'] += 1
+        await asyncio.sleep(self.discord_latency)
+        for embed in embeds:
+            kill_id = int(ZKILLBOARD_URL_PATTERN.search(embed.url).group(1))
+            self.posted[kill_id] = time.monotonic()
+        return HarnessMessage(self, channel)
+
+
+class HarnessChannel:
+    'Channel whose messages are counted and timed by the bot'
+
+    def __init__(self, bot: HarnessBot, channel_id: int):
+        self.id = channel_id
+        self.guild = types.SimpleNamespace(emojis=[])
+        self._bot = bot
+
+    async def send(self, content=None, embed=None, file=None):
+        return await self._bot.send_embeds(self, [embed], content=content,
+                                           files=[file] if file else None)
+
+
+class HarnessMessage:
+    def __init__(self, bot: HarnessBot, channel: HarnessChannel):
+        self.channel = channel
+        self._bot = bot
+
+    async def add_reaction(self, _emoji):
+        self._bot.discord_calls['add_reaction'] += 1
+        await asyncio.sleep(self._bot.discord_latency)
+
+
+def scan_alliances(capture: str, alliance_ids) -> dict:
+    '''Find the member corporations of alliances from the entities seen in a
+    capture, so the ESI stand-in can answer membership lookups'''
+    alliances = {alliance_id: set() for alliance_id in alliance_ids}
+    for _, raw in read_recording(capture):
+        package = json.loads(raw)['package']
+        killmail = package['killmail']
+        for entity in [killmail['victim']] + killmail['attackers']:
+            if entity.get('alliance_id') in alliances \
+                    and 'corporation_id' in entity:
+                alliances[entity['alliance_id']].add(entity['corporation_id'])
+    return alliances
+
+
+async def replay(args):
+    loop = asyncio.get_event_loop()
+    workdir = Path(tempfile.mkdtemp(prefix='killmail-harness-'))
+
+    # Stand-ins for ESI and a cold cache in a scratch directory
+    esi_client = FakeEsiClient(args.esi_latency,
+                               scan_alliances(args.capture, args.alliance))
+
+    session = ReplaySession(read_recording(args.capture),
+                            0 if args.speed == 'max' else float(args.speed))
+    config = {
+        'redisq_queue_id': 'harness',
+        'dedup_path': str(workdir / 'dedup.json'),
+        'workers': args.workers,
+        'queue_size': args.queue_size,
+        'coalesce_window': args.coalesce_window,
+        'wal_path': str(workdir / 'wal'),
+        'stats_path': str(workdir / 'killstats'),
+        'routes': [json.loads(route) for route in args.route],
+        'coalesce_reactions': args.coalesce_reactions,
+        'cards': args.cards,
+        'card_path': str(workdir / 'cards'),
+        'icon_path': str(workdir / 'icons'),
+    }
+    if not args.sde:
+        config['sde_path'] = str(workdir / 'sde.sqlite')
+    bot = HarnessBot(loop, session, config, args.discord_latency)
+
+    killmails_config = KeyValueTable(bot.tdb, 'killmails.config')
+    killmails_config['channel'] = CHANNEL_ID
+    killmails_config['rigs_emoji'] = ''
+    killmails_config['magnate_emoji'] = ''
+    relevancies = bot.tdb.table('killmails.relevancies')
+    for corporation_id in args.corporation:
+        relevancies.insert({'type': 'corporation', 'value': corporation_id})
+    for alliance_id in args.alliance:
+        relevancies.insert({'type': 'alliance', 'value': alliance_id})
+
+    killmail_poster = poster.KillmailPoster(
+        bot, sender=bot.send_embeds, esi_client=esi_client, esi_app=FakeEsiApp(),
+        esi_cache=EsiCache(str(workdir / 'esi.sqlite')))
+    bot.add_cog(killmail_poster)
+    while not killmail_poster.relevancy_index.ready:
+        await asyncio.sleep(0.01)
+    esi_client.calls.clear()
+
+    started = time.monotonic()
+    listener.setup(bot)
+    redisq_listener = bot.get_cog('RedisQListener')
+    await session.exhausted.wait()
+    await redisq_listener.pipeline.queue.join()
+    await killmail_poster.drain()
+    elapsed = time.monotonic() - started
+
+    redisq_listener.close()
+    await killmail_poster.close()
+
+    latencies = sorted(posted - session.received[kill_id]
+                       for kill_id, posted in bot.posted.items())
+    print('Replayed {} packages in {:.2f}s ({:.1f} packages/s)'.format(
+        session.replayed, elapsed, session.replayed / elapsed))
+    print('Filtered {}, duplicates {}, posted {} ({:.1f} posts/s), '
+          'errors {}'.format(redisq_listener.filtered_packages,
+                             redisq_listener.deduplicator.duplicates,
+                             len(bot.posted), len(bot.posted) / elapsed,
+                             bot.errors))
+    print('Time to post: p50 {:.0f}ms, p95 {:.0f}ms, p99 {:.0f}ms'.format(
+        *(percentile(latencies, fraction) * 1000
+          for fraction in (0.5, 0.95, 0.99))))
+    print('Pipeline: max queue depth {}, backpressure {} times for {:.1f}s'
+          .format(redisq_listener.pipeline.max_depth,
+                  redisq_listener.pipeline.backpressure_events,
+                  redisq_listener.pipeline.backpressure_time))
+    print('ESI calls: {} total'.format(sum(esi_client.calls.values())))
+    for name, count in esi_client.calls.most_common():
+        print('  {:<48} {}'.format(name, count))
+    print('Discord calls: {} total'.format(sum(bot.discord_calls.values())))
+    for name, count in bot.discord_calls.most_common():
+        print('  {:<48} {}'.format(name, count))
+    print('WAL: {} appended, {} syncs, {} pending'.format(
+        killmail_poster.wal.appended, killmail_poster.wal.syncs,
+        len(killmail_poster.wal)))
+    stats = killmail_poster.stats
+    low, high = stats.window(0)
+    print('Kill statistics: {} kills, {} losses, {:,.0f} ISK destroyed, '
+          '{:,.0f} ISK lost'.format(*stats.counts(low, high),
+                                    *stats.isk(low, high)))
+    if killmail_poster.cards is not None:
+        print('Cards: {rendered} rendered, p50 {p50:.0f}ms, p95 {p95:.0f}ms, '
+              '{cache_hits} cached, {icons} icons'.format(
+                  **killmail_poster.cards.get_stats()))
+    scheduler = sendqueue.get_send_scheduler(loop)
+    print('Send queue waits:')
+    for name, stats in scheduler.get_stats().items():
+        if stats['sent']:
+            print('  {:<16} {sent:>5} sent, p50 {p50:.2f}s, p95 {p95:.2f}s, '
+                  'max {max:.2f}s'.format(name, **stats))
+    scheduler.stop()
+
+
+async def record(args):
+    recorder = PackageRecorder(args.capture)
+    params = {'queueID': args.queue_id, 'ttw': listener.REDISQ_TIME_TO_WAIT}
+    try:
+        async with aiohttp.ClientSession() as session:
+            while args.count is None or recorder.recorded < args.count:
+                async with session.get(listener.REDISQ_URL,
+                                       params=params) as resp:
+                    resp.raise_for_status()
+                    raw = await resp.read()
+                if raw.strip() != listener.NULL_PACKAGE:
+                    recorder.record(raw)
+                    print('\rRecorded {} packages'.format(recorder.recorded),
+                          end='', file=sys.stderr)
+    finally:
+        recorder.close()
+        print(file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser(
+        'record', help='record live RedisQ packages to a capture')
+    record_parser.add_argument('capture')
+    record_parser.add_argument('--count', type=int, default=None,
+                               help='stop after this many packages')
+    record_parser.add_argument('--queue-id', default='gregbot-harness')
+
+    replay_parser = subparsers.add_parser(
+        'replay', help='replay a capture through the killmail pipeline')
+    replay_parser.add_argument('capture')
+    replay_parser.add_argument('--speed', default='1',
+                               help='replay speed multiplier or "max"')
+    replay_parser.add_argument('--corporation', type=int, action='append',
+                               default=[], help='relevant corporation ID')
+    replay_parser.add_argument('--alliance', type=int, action='append',
+                               default=[], help='relevant alliance ID')
+    replay_parser.add_argument('--esi-latency', type=float, default=0.05)
+    replay_parser.add_argument('--discord-latency', type=float, default=0.1)
+    replay_parser.add_argument('--workers', type=int, default=4)
+    replay_parser.add_argument('--queue-size', type=int, default=100)
+    replay_parser.add_argument('--route', action='append', default=[],
+                               help='killmail route as JSON, e.g. '
+                               '\'{"channel_id": 2, "min_value": 1e9}\'')
+    replay_parser.add_argument('--coalesce-window', type=float, default=0)
+    replay_parser.add_argument('--coalesce-reactions', default='union',
+                               choices=('union', 'skip'))
+    replay_parser.add_argument('--cards', action='store_true',
+                               help='render card images, icons are blank')
+    replay_parser.add_argument('--sde', action='store_true',
+                               help='use the imported SDE instead of ESI')
+
+    args = parser.parse_args()
+    # The cogs log every post at INFO, only show warnings
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    logging.basicConfig(handlers=[handler])
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            record(args) if args.command == 'record' else replay(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
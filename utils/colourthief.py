@@ -1,52 +1,420 @@
+'''
+Embed colours picked from images, computed off the event loop.
+
+Images are downloaded with aiohttp and quantised in a process pool.
+Concurrent requests for one URL share a single computation, and callers
+that cannot wait get a fallback colour while it finishes in the background.
+Colours are kept in a bounded LRU cache on disk and revalidated against the
+image's ETag or content hash, so restarts and icon changes are cheap.
+'''
+import asyncio
+import hashlib
+import json
+import os
+import time
+import typing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+from pathlib import Path
 
-import requests
+import aiohttp
 
 from colorthief import ColorThief as ColourThief
-from colorthief import MMCQ
+from colorthief import MMCQ, CMap, PQueue, VBox
 from discord import Colour
+from PIL import Image
+
+from utils.log import get_logger
+
+FALLBACK_COLOUR = Colour.default()
+COLOUR_TIMEOUT = 2.0
+DOWNLOAD_TIMEOUT = 30
+WORKERS = 1
+COLOUR_CACHE_PATH = 'cache/colours.json'
+COLOUR_CACHE_SIZE = 1000
+REVALIDATE_INTERVAL = 24 * 3600
+SAVE_INTERVAL = 60
+MAX_SAMPLE_PIXELS = 256 * 256
+
+
+def extract_colour(data: bytes) -> int:
+    'Return the dominant saturated colour of an image. Runs in a worker.'
+    return SaturatedColourThief(BytesIO(data)).get_color(1).value
+
+
+class ColourService:
+    '''Computes and caches embed colours of image URLs
+
+    Each cached URL keeps its colour with the ETag and content hash of the
+    image it was picked from. Entries older than REVALIDATE_INTERVAL are
+    still served, while a conditional request checks them in the
+    background, and an unchanged image is never quantised again. Failed
+    computations are not cached, so a later request retries them.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 path: str = COLOUR_CACHE_PATH,
+                 size: int = COLOUR_CACHE_SIZE, workers: int = WORKERS):
+        self.logger = get_logger(__name__)
+        self.loop = loop
+        self.path = Path(path)
+        self.size = size
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self.quantised = 0
+        self._cache: typing.Dict[str, dict] = OrderedDict()
+        self._pending: typing.Dict[str, asyncio.Task] = {}
+        self._executor: ProcessPoolExecutor = None
+        self._session: aiohttp.ClientSession = None
+        self._dirty = False
+
+        self.load()
+        self._save_task = loop.create_task(self._save_loop())
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    async def get_colour(self, url: str,
+                         timeout: typing.Optional[float] = COLOUR_TIMEOUT
+                         ) -> Colour:
+        '''Return the embed colour of the image at url, or the fallback if
+        it is not known within timeout seconds. None waits until it is.'''
+        entry = self._cache.get(url)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(url)
+            if time.time() - entry['checked'] > REVALIDATE_INTERVAL:
+                self._fetch(url)
+            return Colour(entry['colour'])
+
+        self.misses += 1
+        try:
+            colour = await asyncio.wait_for(asyncio.shield(self._fetch(url)),
+                                            timeout)
+        except asyncio.TimeoutError:
+            self.logger.debug('Using the fallback colour for %s', url)
+            return FALLBACK_COLOUR
+        return colour or FALLBACK_COLOUR
+
+    def warm(self, urls: typing.Iterable[str]):
+        'Pick the colours of images not cached yet in the background'
+        for url in urls:
+            if url not in self._cache:
+                self._fetch(url)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            self.logger.exception('Ignoring corrupt colour cache %s',
+                                  self.path)
+            return
+        # Saved least recently used first
+        for url, entry in entries[-self.size:]:
+            self._cache[url] = entry
+        self.logger.info('Loaded %d embed colours', len(self._cache))
+
+    def save(self):
+        'Atomically write the cached colours to disk'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(self._cache.items()), f)
+        os.replace(str(tmp_path), str(self.path))
+        self._dirty = False
+
+    def stop(self):
+        '''Save the cache and release the worker pool and session. The next
+        get_colour_service call starts a new service.'''
+        global _service  # pylint: disable=global-statement
+        if _service is self:
+            _service = None
+        self._save_task.cancel()
+        if self._dirty:
+            self.save()
+        for task in list(self._pending.values()):
+            task.cancel()
+        if self._session is not None:
+            self.loop.create_task(self._session.close())
+            self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _fetch(self, url: str) -> asyncio.Task:
+        'Start fetching the colour of url, unless that is already under way'
+        task = self._pending.get(url)
+        if task is None:
+            task = self._pending[url] = self.loop.create_task(
+                self._compute(url))
+            task.add_done_callback(lambda _: self._pending.pop(url, None))
+        return task
+
+    async def _compute(self, url: str) -> typing.Optional[Colour]:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT))
+
+        entry = self._cache.get(url)
+        headers = {}
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        try:
+            async with self._session.get(url, headers=headers) as resp:
+                if resp.status == 304:
+                    self._store(url, dict(entry, checked=time.time()))
+                    return Colour(entry['colour'])
+                resp.raise_for_status()
+                data = await resp.read()
+                etag = resp.headers.get('ETag')
+
+            # The same image may be cached under this or another URL
+            digest = hashlib.sha256(data).hexdigest()
+            value = next((cached['colour'] for cached in self._cache.values()
+                          if cached['hash'] == digest), None)
+            if value is None:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(self.workers)
+                value = await self.loop.run_in_executor(
+                    self._executor, extract_colour, data)
+                self.quantised += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            self.logger.warning('Failed to download %s: %s', url, exception)
+            return None
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception('Failed to pick the colour of %s', url)
+            return None
+
+        self._store(url, {'colour': value, 'etag': etag, 'hash': digest,
+                          'checked': time.time()})
+        return Colour(value)
+
+    def _store(self, url: str, entry: dict):
+        self._cache[url] = entry
+        self._cache.move_to_end(url)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+        self._dirty = True
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError:
+                    self.logger.exception('Failed to save colour cache')
+
+
+_service: ColourService = None
+
 
+def get_colour_service(loop: asyncio.AbstractEventLoop) -> ColourService:
+    'Return the service shared by every relay, creating it on first use'
+    global _service  # pylint: disable=global-statement
+    if _service is None:
+        _service = ColourService(loop)
+    return _service
 
-def get_embed_colour(url):
-    colour_thief = SaturatedColourThief(
-        BytesIO(requests.get(url).content)
-    )
-    return colour_thief.get_color(1)
+
+def is_saturated(red: int, green: int, blue: int) -> bool:
+    'Whether a colour is neither very dark, very light nor greyscale'
+    max_rgb = max(red, green, blue) / 255.0
+    min_rgb = min(red, green, blue) / 255.0
+    lightness = 0.5 * (max_rgb + min_rgb)
+    if lightness <= 0.1 or lightness > 0.9:
+        return False  # Skip very dark/light pixels
+    if lightness <= 0.5:
+        saturation = (max_rgb - min_rgb) / (2 * lightness)
+    else:
+        saturation = (max_rgb - min_rgb) / (2 - 2 * lightness)
+    return saturation > 0.4  # Skip 'greyscale' pixels
+
+
+class SparseVBox(VBox):
+    '''VBox walking the histogram entries inside it instead of every cell
+    of its volume, which is far fewer for the colours of an icon
+
+    `colours` holds (red, green, blue, count) per histogram entry.'''
+
+    def __init__(self, r1, r2, g1, g2, b1, b2, histo, colours):
+        super(SparseVBox, self).__init__(r1, r2, g1, g2, b1, b2, histo)
+        self.colours = [colour for colour in colours
+                        if r1 <= colour[0] <= r2 and g1 <= colour[1] <= g2
+                        and b1 <= colour[2] <= b2]
+        self._count: int = None
+        self._avg: typing.Tuple[int, int, int] = None
+
+    @property
+    def copy(self):
+        return SparseVBox(self.r1, self.r2, self.g1, self.g2, self.b1,
+                          self.b2, self.histo, self.colours)
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._count = sum(colour[3] for colour in self.colours)
+        return self._count
+
+    @property
+    def avg(self):
+        if self._avg is None:
+            mult = 1 << (8 - MMCQ.SIGBITS)
+            ntot = self.count
+            if not ntot:
+                self._avg = (int(mult * (self.r1 + self.r2 + 1) / 2),
+                             int(mult * (self.g1 + self.g2 + 1) / 2),
+                             int(mult * (self.b1 + self.b2 + 1) / 2))
+            else:
+                self._avg = tuple(
+                    int(sum(colour[3] * (colour[axis] + 0.5) * mult
+                            for colour in self.colours) / ntot)
+                    for axis in range(3))
+        return self._avg
+
+
+def median_cut_apply(vbox: SparseVBox):
+    'MMCQ.median_cut_apply summing the entries of a SparseVBox'
+    if not vbox.count:
+        return (None, None)
+    # only one pixel, no split
+    if vbox.count == 1:
+        return (vbox.copy, None)
+
+    widths = (vbox.r2 - vbox.r1 + 1, vbox.g2 - vbox.g1 + 1,
+              vbox.b2 - vbox.b1 + 1)
+    # Ties prefer red, then green, like MMCQ
+    axis = widths.index(max(widths))
+    dim1, dim2 = 'rgb'[axis] + '1', 'rgb'[axis] + '2'
+    dim1_val = getattr(vbox, dim1)
+    dim2_val = getattr(vbox, dim2)
+
+    # Find the partial sum arrays along the selected axis.
+    sums = [0] * (dim2_val - dim1_val + 1)
+    for colour in vbox.colours:
+        sums[colour[axis] - dim1_val] += colour[3]
+    total = 0
+    partialsum = {}
+    for i, sum_ in enumerate(sums, dim1_val):
+        total += sum_
+        partialsum[i] = total
+    lookaheadsum = {i: total - d for i, d in partialsum.items()}
+
+    # determine the cut planes
+    for i in range(dim1_val, dim2_val + 1):
+        if partialsum[i] > (total / 2):
+            vbox1 = vbox.copy
+            vbox2 = vbox.copy
+            left = i - dim1_val
+            right = dim2_val - i
+            if left <= right:
+                d2 = min([dim2_val - 1, int(i + right / 2)])
+            else:
+                d2 = max([dim1_val, int(i - 1 - left / 2)])
+            # avoid 0-count boxes
+            while not partialsum.get(d2, False):
+                d2 += 1
+            count2 = lookaheadsum.get(d2)
+            while not count2 and partialsum.get(d2 - 1, False):
+                d2 -= 1
+                count2 = lookaheadsum.get(d2)
+            # set dimensions, narrowing the entries to the new bounds
+            setattr(vbox1, dim2, d2)
+            setattr(vbox2, dim1, d2 + 1)
+            return (vbox1.copy, vbox2.copy)
+    return (None, None)
+
+
+def quantize_histogram(histo: typing.Dict[int, int], max_color: int) -> CMap:
+    '''MMCQ.quantize on a histogram of colour indices, as built by
+    MMCQ.get_histo, instead of a list of pixels'''
+    if not histo:
+        raise Exception('Empty pixels when quantize.')
+
+    mask = (1 << MMCQ.SIGBITS) - 1
+    colours = [(index >> (2 * MMCQ.SIGBITS), (index >> MMCQ.SIGBITS) & mask,
+                index & mask, count) for index, count in histo.items()]
+    vbox = SparseVBox(min(colour[0] for colour in colours),
+                      max(colour[0] for colour in colours),
+                      min(colour[1] for colour in colours),
+                      max(colour[1] for colour in colours),
+                      min(colour[2] for colour in colours),
+                      max(colour[2] for colour in colours), histo, colours)
+    pq = PQueue(lambda x: x.count)
+    pq.push(vbox)
+
+    # Same iteration as MMCQ.quantize
+    def iter_(lh, target):
+        n_color = 1
+        n_iter = 0
+        while n_iter < MMCQ.MAX_ITERATION:
+            vbox = lh.pop()
+            if not vbox.count:  # just put it back
+                lh.push(vbox)
+                n_iter += 1
+                continue
+            vbox1, vbox2 = median_cut_apply(vbox)
+            lh.push(vbox1)
+            if vbox2:  # vbox2 can be null
+                lh.push(vbox2)
+                n_color += 1
+            if n_color >= target:
+                return
+            n_iter += 1
+
+    # First set of colours, sorted by population, then by population times
+    # the size in colour space
+    iter_(pq, MMCQ.FRACT_BY_POPULATIONS * max_color)
+    pq2 = PQueue(lambda x: x.count * x.volume)
+    while pq.size():
+        pq2.push(pq.pop())
+    iter_(pq2, max_color - pq2.size())
+
+    cmap = CMap()
+    while pq2.size():
+        cmap.push(pq2.pop())
+    return cmap
 
 
 class SaturatedColourThief(ColourThief):
+    '''ColourThief preferring saturated colours
+
+    Large images are sampled down to MAX_SAMPLE_PIXELS first, keeping the
+    colours of the sampled pixels intact. Pixels are then counted per
+    distinct colour by Pillow, so the Python work grows with the number of
+    colours rather than the size of the image.'''
+
     def get_palette(self, color_count=10, quality=10):
         image = self.image.convert('RGBA')
-        pixels = image.getdata()
-        pixel_count = image.size[0] * image.size[1]
-        valid_pixels = []
-        for i in range(0, pixel_count, quality):
-            # red, green, blue, alpha = pixels[i]
+        width, height = image.size
+        fraction = min(1 / quality, MAX_SAMPLE_PIXELS / (width * height))
+        if fraction < 1:
+            scale = fraction ** 0.5
+            image = image.resize((max(1, round(width * scale)),
+                                  max(1, round(height * scale))),
+                                 Image.Resampling.NEAREST)
 
-            if pixels[i][3] < 125:  # Skip pixels with low alpha
+        saturated = {}
+        opaque = {}
+        colours = image.getcolors(image.size[0] * image.size[1])
+        for count, (red, green, blue, alpha) in colours:
+            if alpha < 125:  # Skip pixels with low alpha
                 continue
-            max_rgb = max(pixels[i][:3]) / 255.0
-            min_rgb = min(pixels[i][:3]) / 255.0
-            lightness = 0.5 * (max_rgb + min_rgb)
-            if lightness <= 0.1 or lightness > 0.9:
-                continue  # Skip very dark/light pixels
-            if lightness <= 0.5:
-                saturation = (max_rgb - min_rgb) / (2 * lightness)
-            else:
-                saturation = (max_rgb - min_rgb) / (2 - 2 * lightness)
-            if saturation > 0.4:  # Skip 'greyscale' pixels
-                valid_pixels.append(pixels[i][:3])
-
-        if not valid_pixels:  # Fall back to original method.
-            palette = super(SaturatedColourThief, self).get_palette(
-                color_count, quality
-            )
-            return palette
-
-        # Send array to quantize function which clusters values
-        # using median cut algorithm
-        cmap = MMCQ.quantize(valid_pixels, color_count)
-        return cmap.palette
+            index = MMCQ.get_color_index(red >> MMCQ.RSHIFT,
+                                         green >> MMCQ.RSHIFT,
+                                         blue >> MMCQ.RSHIFT)
+            if is_saturated(red, green, blue):
+                saturated[index] = saturated.get(index, 0) + count
+            # What ColourThief itself counts, for images without saturation
+            if not (red > 250 and green > 250 and blue > 250):
+                opaque[index] = opaque.get(index, 0) + count
+
+        # Send the histogram to the median cut quantizer
+        return quantize_histogram(saturated or opaque, color_count).palette
 
     def get_color(self, quality):
         colour = super(SaturatedColourThief, self).get_color(quality)
@@ -0,0 +1,122 @@
+'''
+Two-tier cache for ESI responses.
+
+Entries live in an in-memory LRU and are mirrored to an SQLite file, so
+static universe data survives restarts.
+'''
+import json
+import sqlite3
+import time
+import typing
+from collections import OrderedDict
+from pathlib import Path
+
+from utils.log import get_logger
+
+DEFAULT_CACHE_PATH = 'cache/esi.sqlite'
+DEFAULT_MEMORY_SIZE = 4096
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+class EsiCache:
+    '''Memory LRU in front of an on-disk key/value table with expiry'''
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH,
+                 memory_size: int = DEFAULT_MEMORY_SIZE,
+                 ttl: float = DEFAULT_TTL):
+        self.logger = get_logger(__name__)
+        self.path = Path(path)
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._db = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(op_name: str, params: dict) -> str:
+        'Build a stable cache key from an operation name and its parameters'
+        return '{}:{}'.format(op_name, json.dumps(params, sort_keys=True))
+
+    def get(self, key: str) -> typing.Any:
+        'Return the cached value for key, or None if absent or expired'
+        now = time.time()
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._memory[key]
+
+        row = self._get_db().execute(
+            'SELECT expires, value FROM entries WHERE key = ?',
+            (key, )).fetchone()
+        if row is not None and row[0] > now:
+            value = json.loads(row[1])
+            self._remember(key, row[0], value)
+            self.disk_hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: typing.Any, ttl: float = None):
+        'Store value under key in both tiers'
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, expires, value)
+
+        db = self._get_db()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO entries (key, expires, value) '
+                'VALUES (?, ?, ?)', (key, expires, json.dumps(value)))
+
+    def clear(self):
+        'Drop every entry from both tiers'
+        self._memory.clear()
+        db = self._get_db()
+        with db:
+            db.execute('DELETE FROM entries')
+
+    def get_stats(self) -> dict:
+        'Return the hit/miss counters and the memory tier occupancy'
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.disk_hits) / lookups
+                         if lookups else 0.0,
+            'size': len(self._memory),
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, key: str, expires: float, value: typing.Any):
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _get_db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path))
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS entries ('
+                    'key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+                pruned = self._db.execute(
+                    'DELETE FROM entries WHERE expires <= ?',
+                    (time.time(), )).rowcount
+            self.logger.info('Opened ESI cache %s (pruned %d expired)',
+                             self.path, pruned)
+        return self._db
@@ -0,0 +1,164 @@
+'''
+Native asyncio client for ESI.
+
+Executes pyswagger operations created by an esipy App over a pooled aiohttp
+session, revalidating with ETags and honouring the Expires header instead
+of going through esipy's synchronous requests-based client.
+'''
+import asyncio
+import json
+import time
+import typing
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+from utils.log import get_logger
+
+USER_AGENT = 'antinub-gregbot (https://github.com/greg2010/antinub-gregbot)'
+POOL_SIZE = 20
+REQUEST_TIMEOUT = 30
+KEEPALIVE_TIMEOUT = 60
+VALIDATOR_CACHE_SIZE = 2048
+RETRIES = 3
+RETRY_STATUSES = (502, 503, 504)
+RETRY_BACKOFF = 0.5
+
+
+class _Validator(typing.NamedTuple):
+    etag: str
+    expires: float
+    header: dict
+    raw: bytes
+
+
+class AsyncEsiClient:
+    '''Performs esipy/pyswagger operations over a shared aiohttp session'''
+
+    def __init__(self, pool_size: int = POOL_SIZE,
+                 cache_size: int = VALIDATOR_CACHE_SIZE,
+                 retries: int = RETRIES):
+        self.logger = get_logger(__name__)
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self.retries = retries
+        self._session: aiohttp.ClientSession = None
+        self._validators = OrderedDict()
+
+        self.requests = 0
+        self.not_modified = 0
+        self.fresh_hits = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                headers={
+                    'User-Agent': USER_AGENT,
+                    'Accept': 'application/json'
+                })
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, req_and_resp, raw_body_only: bool = False):
+        '''Perform the operation and return the filled pyswagger Response'''
+        request, response = req_and_resp
+        request.reset()
+        response.reset()
+        request.prepare(scheme='https', handle_files=False)
+        method = request.method.upper()
+        headers = dict(request.header)
+
+        key = None
+        validator = None
+        if method == 'GET':
+            key = (request.url, tuple(sorted(request.query)))
+            validator = self._validators.get(key)
+            if validator is not None:
+                self._validators.move_to_end(key)
+                if validator.expires > time.time():
+                    self.fresh_hits += 1
+                    return self._fill(response, 200, validator.header,
+                                      validator.raw, raw_body_only)
+                if validator.etag is not None:
+                    headers['If-None-Match'] = validator.etag
+
+        status, header, raw = await self._send(method, request.url,
+                                               request.query, request.data,
+                                               headers)
+
+        if status == 304 and validator is not None:
+            self.not_modified += 1
+            header = dict(validator.header, **header)
+            status, raw = 200, validator.raw
+
+        if key is not None and status == 200:
+            self._remember(key, header, raw)
+
+        if 'warning' in header:
+            self.logger.warning('[%s] %s', request.url, header['warning'])
+
+        return self._fill(response, status, header, raw, raw_body_only)
+
+    async def _send(self, method, url, query, data, headers):
+        for attempt in range(self.retries + 1):
+            self.requests += 1
+            try:
+                async with self._get_session().request(
+                        method, url, params=query, data=data,
+                        headers=headers) as res:
+                    raw = await res.read()
+                    status = res.status
+                    header = {k.lower(): v for k, v in res.headers.items()}
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+                status = 500
+                header = {}
+                raw = json.dumps({'error': str(exception)}).encode()
+
+            if status not in RETRY_STATUSES + (500, ) \
+                    or attempt == self.retries:
+                break
+            await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+        return status, header, raw
+
+    def _remember(self, key, header: dict, raw: bytes):
+        expires = 0.0
+        if 'expires' in header:
+            try:
+                expires = parsedate_to_datetime(header['expires']).timestamp()
+            except (TypeError, ValueError):
+                pass
+
+        etag = header.get('etag')
+        if etag is None and expires <= time.time():
+            self._validators.pop(key, None)
+            return
+
+        self._validators[key] = _Validator(etag, expires, header, raw)
+        self._validators.move_to_end(key)
+        while len(self._validators) > self.cache_size:
+            self._validators.popitem(last=False)
+
+    @staticmethod
+    def _fill(response, status: int, header: dict, raw: bytes,
+              raw_body_only: bool):
+        response.raw_body_only = raw_body_only
+        response.apply_with(status=status, header=header, raw=raw)
+        return response
+
+    def get_stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'not_modified': self.not_modified,
+            'fresh_hits': self.fresh_hits,
+        }
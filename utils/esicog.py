@@ -1,9 +1,13 @@
 import asyncio
+import collections
+import json
 
 import esipy
 from discord.ext import commands
-from requests.adapters import DEFAULT_POOLSIZE
 
+from utils.esicache import EsiCache
+from utils.esiclient import POOL_SIZE, AsyncEsiClient
+from utils.esinames import NameResolver
 from utils.log import get_logger
 
 ESI_SWAGGER_JSON = 'https://esi.evetech.net/dev/swagger.json'
@@ -11,12 +15,30 @@ ESI_SWAGGER_JSON = 'https://esi.evetech.net/dev/swagger.json'
 
 class EsiCog:
     _esi_app_task: asyncio.Task = None
-    _semaphore = asyncio.Semaphore(DEFAULT_POOLSIZE)
+    _semaphore = asyncio.Semaphore(POOL_SIZE)
+    _esi_client = AsyncEsiClient()
+    _cache = EsiCache()
+    _cache_pending = {}
+    _name_resolver: NameResolver = None
+    _client_users = collections.Counter()
 
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, esi_client: AsyncEsiClient = None,
+                 esi_app: esipy.App = None, esi_cache: EsiCache = None):
+        '''esi_client, esi_app and esi_cache replace the client, esipy App
+        and cache shared by every cog, for this cog only.'''
         logger = get_logger(__name__)
 
-        if EsiCog._esi_app_task is None:
+        if esi_client is not None:
+            self._esi_client = esi_client
+        EsiCog._client_users[self._esi_client] += 1
+        if esi_cache is not None:
+            self._cache = esi_cache
+            self._name_resolver = NameResolver(bot.loop, esi_cache,
+                                               self._post_universe_names)
+        if esi_app is not None:
+            self._esi_app_task = bot.loop.create_future()
+            self._esi_app_task.set_result(esi_app)
+        elif EsiCog._esi_app_task is None:
             logger.info("Creating esipy App...")
             EsiCog._esi_app_task = bot.loop.run_in_executor(
                 None, self._create_esi_app)
@@ -29,6 +51,71 @@ class EsiCog:
     def _create_esi_app(self):
         return esipy.App.create(url=ESI_SWAGGER_JSON)
 
-    async def esi_request(self, loop, client, operation):
+    async def esi_request(self, operation):
+        'Perform an ESI operation on the shared asyncio client'
         async with self._semaphore:
-            return await loop.run_in_executor(None, client.request, operation)
+            return await self._esi_client.request(operation)
+
+    async def esi_cached_request(self, op_name, ttl=None, **params):
+        '''Return the decoded body of an ESI operation, served from the cache
+        when possible. Concurrent misses for the same key share one request.
+        Raises RuntimeError if ESI responds with an error.'''
+        key = EsiCache.make_key(op_name, params)
+        data = self._cache.get(key)
+        if data is not None:
+            return data
+
+        pending = self._cache_pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_event_loop().create_future()
+        self._cache_pending[key] = future
+        try:
+            esi_app = await self.get_esi_app()
+            response = await self.esi_request(esi_app.op[op_name](**params))
+            if response.status != 200:
+                raise RuntimeError('{} responded with {}: {}'.format(
+                    op_name, response.status, response.raw))
+            data = json.loads(response.raw)
+            self._cache.set(key, data, ttl)
+            future.set_result(data)
+        except Exception as exception:
+            future.set_exception(exception)
+            # Mark the exception as retrieved if nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._cache_pending[key]
+
+        return data
+
+    async def resolve_names(self, loop, ids):
+        '''Resolve entity IDs to names. Lookups from concurrent callers are
+        batched into bulk /universe/names/ requests.'''
+        if self._name_resolver is None:
+            EsiCog._name_resolver = NameResolver(loop, self._cache,
+                                                 self._post_universe_names)
+        return await self._name_resolver.resolve(ids)
+
+    async def _post_universe_names(self, ids):
+        esi_app = await self.get_esi_app()
+        response = await self.esi_request(
+            esi_app.op['post_universe_names'](ids=ids))
+        return response.status, json.loads(response.raw)
+
+    async def close_esi_session(self):
+        '''Release this cog's use of the ESI client, closing its pooled
+        connections once no other cog uses it'''
+        EsiCog._client_users[self._esi_client] -= 1
+        if EsiCog._client_users[self._esi_client] <= 0:
+            del EsiCog._client_users[self._esi_client]
+            await self._esi_client.close()
+
+    def get_cache_stats(self) -> dict:
+        return self._cache.get_stats()
+
+    def get_client_stats(self) -> dict:
+        return self._esi_client.get_stats()
@@ -0,0 +1,116 @@
+'''
+Batched ID to name resolution.
+
+IDs requested within a short window by any number of callers are resolved
+together with bulk POST /universe/names/ requests, and each caller awaits a
+per-ID future. Resolved names are kept in the shared EsiCache.
+'''
+import asyncio
+import typing
+
+from utils.esicache import EsiCache
+from utils.log import get_logger
+
+BATCH_WINDOW = 0.05
+BATCH_SIZE = 1000  # Maximum number of IDs ESI accepts per request
+NAME_TTL = 24 * 3600
+
+
+class NameResolver:
+    '''Coalesces name lookups into bulk requests
+
+    `request` is a coroutine function taking a list of IDs and returning
+    the HTTP status and decoded body of a /universe/names/ request.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, cache: EsiCache,
+                 request: typing.Callable[[list], typing.Awaitable[tuple]],
+                 window: float = BATCH_WINDOW):
+        self.logger = get_logger(__name__)
+        self.loop = loop
+        self.cache = cache
+        self.window = window
+        self.batches = 0
+
+        self._request = request
+        self._pending: typing.Dict[int, asyncio.Future] = {}
+        self._queued: typing.List[int] = []
+        self._flush_handle: asyncio.TimerHandle = None
+
+    async def resolve(self, ids: typing.Iterable[int]
+                      ) -> typing.Dict[int, typing.Optional[str]]:
+        'Return a mapping of each ID to its name, None if ESI does not know it'
+        ids = set(ids)
+        ids.discard(None)
+        futures = {entity_id: self.get(entity_id) for entity_id in ids}
+        names = await asyncio.gather(*map(asyncio.shield, futures.values()))
+        return dict(zip(futures, names))
+
+    def get(self, entity_id: int) -> asyncio.Future:
+        'Return a future for the name of a single ID'
+        future = self._pending.get(entity_id)
+        if future is not None:
+            return future
+
+        future = self.loop.create_future()
+        name = self.cache.get(self._key(entity_id))
+        if name is not None:
+            future.set_result(name)
+            return future
+
+        self._pending[entity_id] = future
+        self._queued.append(entity_id)
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.window, self._flush)
+        return future
+
+    @staticmethod
+    def _key(entity_id: int) -> str:
+        return EsiCache.make_key('post_universe_names', {'id': entity_id})
+
+    def _flush(self):
+        self._flush_handle = None
+        queued, self._queued = self._queued, []
+        for start in range(0, len(queued), BATCH_SIZE):
+            self.loop.create_task(
+                self._resolve_batch(queued[start:start + BATCH_SIZE]))
+
+    async def _resolve_batch(self, ids: typing.List[int]):
+        try:
+            names = await self._fetch(ids)
+        except Exception as exception:
+            self.logger.warning('Failed to resolve %d names: %s', len(ids),
+                                exception)
+            for entity_id in ids:
+                future = self._pending.pop(entity_id)
+                if not future.done():
+                    future.set_exception(exception)
+                    future.exception()
+            return
+
+        for entity_id in ids:
+            name = names.get(entity_id)
+            if name is not None:
+                self.cache.set(self._key(entity_id), name, NAME_TTL)
+            future = self._pending.pop(entity_id)
+            if not future.done():
+                future.set_result(name)
+
+    async def _fetch(self, ids: typing.List[int]) -> typing.Dict[int, str]:
+        self.batches += 1
+        status, body = await self._request(ids)
+        if status == 200:
+            return {entry['id']: entry['name'] for entry in body}
+
+        # ESI rejects the whole batch if a single ID is invalid, so bisect
+        # until the offending IDs are isolated.
+        if status == 404:
+            if len(ids) == 1:
+                return {}
+            middle = len(ids) // 2
+            first, second = await asyncio.gather(
+                self._fetch(ids[:middle]), self._fetch(ids[middle:]))
+            first.update(second)
+            return first
+
+        raise RuntimeError('/universe/names/ responded with {}: {}'.format(
+            status, body))
@@ -0,0 +1,62 @@
+'''
+Bounded set whose members expire after a time window.
+'''
+import time
+import typing
+from collections import OrderedDict
+
+
+class ExpiringSet:
+    '''Set of hashable keys remembered for at most `window` seconds and
+    bounded to `maxsize` members, oldest first out.
+
+    Members are kept in insertion order, so adding, checking and expiring
+    are all amortised constant time.'''
+
+    def __init__(self, maxsize: int, window: float,
+                 clock: typing.Callable[[], float] = time.time):
+        self.maxsize = maxsize
+        self.window = window
+        self.clock = clock
+        self._entries: typing.Dict[typing.Hashable, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        self.expire()
+        return key in self._entries
+
+    def add(self, key: typing.Hashable, timestamp: float = None) -> bool:
+        '''Add key, returning False if it was already a member. The original
+        timestamp is kept for existing members.'''
+        now = self.clock() if timestamp is None else timestamp
+        self.expire(now)
+        if key in self._entries:
+            return False
+
+        self._entries[key] = now
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return True
+
+    def expire(self, now: float = None):
+        'Drop members older than the window'
+        cutoff = (self.clock() if now is None else now) - self.window
+        entries = self._entries
+        while entries:
+            key, timestamp = next(iter(entries.items()))
+            if timestamp > cutoff:
+                break
+            del entries[key]
+
+    def items(self) -> typing.List[typing.Tuple[typing.Hashable, float]]:
+        'Return (key, timestamp) pairs, oldest first'
+        self.expire()
+        return list(self._entries.items())
+
+    def update(self, items: typing.Iterable[typing.Tuple[typing.Hashable,
+                                                         float]]):
+        'Add (key, timestamp) pairs, e.g. ones previously returned by items'
+        for key, timestamp in sorted(items, key=lambda item: item[1]):
+            self.add(key, timestamp)
@@ -0,0 +1,38 @@
+'''
+Key-value view of a TinyDB table.
+'''
+import typing
+
+import tinydb
+
+
+class KeyValueTable:
+    '''Stores each key as a {"key": ..., "value": ...} document of a TinyDB
+    table and reads it back like a dict'''
+
+    def __init__(self, tdb: tinydb.TinyDB, name: str):
+        self.table = tdb.table(name)
+        self._query = tinydb.Query()
+
+    def __contains__(self, key: str) -> bool:
+        return self.table.contains(self._query.key == key)
+
+    def __getitem__(self, key: str) -> typing.Any:
+        document = self.table.get(self._query.key == key)
+        if document is None:
+            raise KeyError(key)
+        return document['value']
+
+    def __setitem__(self, key: str, value: typing.Any):
+        self.table.upsert({'key': key, 'value': value},
+                          self._query.key == key)
+
+    def __delitem__(self, key: str):
+        if not self.table.remove(self._query.key == key):
+            raise KeyError(key)
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -3,6 +3,11 @@ Contains utilities regarding messages
 """
 from math import ceil
 
+import discord
+from discord.http import Route
+
+from utils.sendqueue import OWNER_ALERT, get_send_scheduler
+
 
 class Paginate:
     'Chop a string into even chunks of max_length around the given separator'
@@ -69,8 +74,31 @@ class Paginate:
 async def notify_owner(bot, messages):
     'Send message to the private channel of the owner'
     user = await bot.fetch_user(bot.owner_id)
+    scheduler = get_send_scheduler(bot.loop)
     for message in messages:
-        await user.send(message)
+        await scheduler.send_message(OWNER_ALERT, user, content=message)
+
+
+async def send_embeds(channel, embeds, content=None, files=None):
+    'Send a single message carrying up to 10 embeds and files to channel'
+    # Messageable.send only takes one embed, so post to the route directly
+    route = Route('POST', '/channels/{channel_id}/messages',
+                  channel_id=channel.id)
+    payload = {'embeds': [embed.to_dict() for embed in embeds]}
+    if content is not None:
+        payload['content'] = content
+    if files:
+        form = [{'name': 'payload_json', 'value': discord.utils.to_json(
+            payload)}]
+        for index, file in enumerate(files):
+            form.append({'name': 'file{}'.format(index), 'value': file.fp,
+                         'filename': file.filename,
+                         'content_type': 'application/octet-stream'})
+        data = await channel._state.http.request(route, form=form,
+                                                 files=files)
+    else:
+        data = await channel._state.http.request(route, json=payload)
+    return discord.Message(state=channel._state, channel=channel, data=data)
 
 
 async def message_input(ctx, prompt, timeout=60):
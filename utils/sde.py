@@ -0,0 +1,250 @@
+'''
+Offline EVE static data export (SDE) backend.
+
+Imports the Fuzzwork CSV conversion of the SDE into an indexed SQLite file
+and serves universe and type lookups from it, shaped like the matching ESI
+responses, so static data is available without touching ESI.
+'''
+import bz2
+import csv
+import io
+import os
+import sqlite3
+import time
+import typing
+from pathlib import Path
+
+import requests
+
+from utils.log import get_logger
+
+SDE_PATH = 'cache/sde.sqlite'
+SDE_BASE_URL = 'https://www.fuzzwork.co.uk/dump/latest/{}.csv.bz2'
+# The Last-Modified header of this dump identifies the SDE release
+SDE_VERSION_TABLE = 'invTypes'
+SCHEMA_VERSION = 2
+MMAP_SIZE = 256 * 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE regions (region_id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE constellations (constellation_id INTEGER PRIMARY KEY,
+                             region_id INTEGER, name TEXT);
+CREATE TABLE solar_systems (system_id INTEGER PRIMARY KEY,
+                            constellation_id INTEGER, region_id INTEGER,
+                            name TEXT, security_status REAL);
+CREATE TABLE types (type_id INTEGER PRIMARY KEY, group_id INTEGER,
+                    name TEXT);
+CREATE TABLE type_attributes (type_id INTEGER, attribute_id INTEGER,
+                              value REAL,
+                              PRIMARY KEY (type_id, attribute_id))
+                              WITHOUT ROWID;
+CREATE TABLE jumps (from_system_id INTEGER, to_system_id INTEGER,
+                    PRIMARY KEY (from_system_id, to_system_id))
+                    WITHOUT ROWID;
+'''
+
+# table name -> (Fuzzwork dump, [(column, CSV header)])
+IMPORTS = {
+    'regions': ('mapRegions', [('region_id', 'regionID'),
+                               ('name', 'regionName')]),
+    'constellations': ('mapConstellations',
+                       [('constellation_id', 'constellationID'),
+                        ('region_id', 'regionID'),
+                        ('name', 'constellationName')]),
+    'solar_systems': ('mapSolarSystems', [('system_id', 'solarSystemID'),
+                                          ('constellation_id',
+                                           'constellationID'),
+                                          ('region_id', 'regionID'),
+                                          ('name', 'solarSystemName'),
+                                          ('security_status', 'security')]),
+    'types': ('invTypes', [('type_id', 'typeID'), ('group_id', 'groupID'),
+                           ('name', 'typeName')]),
+    'type_attributes': ('dgmTypeAttributes', [('type_id', 'typeID'),
+                                              ('attribute_id', 'attributeID'),
+                                              ('value', ('valueFloat',
+                                                         'valueInt'))]),
+    'jumps': ('mapSolarSystemJumps', [('from_system_id', 'fromSolarSystemID'),
+                                      ('to_system_id', 'toSolarSystemID')]),
+}
+
+
+class StaticData:
+    '''Read-only view of the imported SDE. Lookups return None when the SDE
+    is not imported or does not contain the requested row.'''
+
+    def __init__(self, path: str = SDE_PATH):
+        self.logger = get_logger(__name__)
+        self.path = Path(path)
+        self._db: sqlite3.Connection = None
+        self.meta: typing.Dict[str, str] = {}
+        self.reload()
+
+    @property
+    def available(self) -> bool:
+        return self._db is not None
+
+    @property
+    def version(self) -> typing.Optional[str]:
+        return self.meta.get('version')
+
+    def reload(self):
+        'Reopen the database, e.g. after a new import'
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self.meta = {}
+
+        if not self.path.exists():
+            return
+
+        db = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA mmap_size = {:d}'.format(MMAP_SIZE))
+        meta = dict(db.execute('SELECT key, value FROM meta'))
+        if int(meta.get('schema_version', 0)) != SCHEMA_VERSION:
+            self.logger.warning('Ignoring SDE at %s with outdated schema',
+                                self.path)
+            db.close()
+            return
+
+        self._db = db
+        self.meta = meta
+        self.logger.info('Loaded SDE version %s', self.version)
+
+    def _fetch(self, query: str, *params) -> typing.Optional[dict]:
+        if self._db is None:
+            return None
+        row = self._db.execute(query, params).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_region(self, region_id: int) -> typing.Optional[dict]:
+        return self._fetch(
+            'SELECT region_id, name FROM regions WHERE region_id = ?',
+            region_id)
+
+    def get_constellation(self,
+                          constellation_id: int) -> typing.Optional[dict]:
+        return self._fetch(
+            'SELECT constellation_id, region_id, name FROM constellations '
+            'WHERE constellation_id = ?', constellation_id)
+
+    def get_solar_system(self, system_id: int) -> typing.Optional[dict]:
+        return self._fetch(
+            'SELECT system_id, constellation_id, name, security_status '
+            'FROM solar_systems WHERE system_id = ?', system_id)
+
+    def get_type(self, type_id: int) -> typing.Optional[dict]:
+        record = self._fetch(
+            'SELECT type_id, group_id, name FROM types WHERE type_id = ?',
+            type_id)
+        if record is not None:
+            record['dogma_attributes'] = [
+                dict(row) for row in self._db.execute(
+                    'SELECT attribute_id, value FROM type_attributes '
+                    'WHERE type_id = ?', (type_id, ))
+            ]
+        return record
+
+    def get_type_attribute(self, type_id: int,
+                           attribute_id: int) -> typing.Optional[float]:
+        record = self._fetch(
+            'SELECT value FROM type_attributes '
+            'WHERE type_id = ? AND attribute_id = ?', type_id, attribute_id)
+        return record['value'] if record is not None else None
+
+    def get_attribute_values(self,
+                             attribute_id: int) -> typing.Dict[int, float]:
+        'Return type_id -> value for every type having the attribute'
+        if self._db is None:
+            return {}
+        return dict(self._db.execute(
+            'SELECT type_id, value FROM type_attributes '
+            'WHERE attribute_id = ?', (attribute_id, )))
+
+    def get_jumps(self) -> typing.List[typing.Tuple[int, int]]:
+        'Return every stargate connection as (from, to) system IDs'
+        if self._db is None:
+            return []
+        return self._db.execute(
+            'SELECT from_system_id, to_system_id FROM jumps').fetchall()
+
+
+_static_data: typing.Dict[str, StaticData] = {}
+
+
+def get_static_data(path: str = SDE_PATH) -> StaticData:
+    'Return the process-wide StaticData instance of the SDE at path'
+    static_data = _static_data.get(path)
+    if static_data is None:
+        static_data = _static_data[path] = StaticData(path)
+    return static_data
+
+
+def get_remote_version() -> str:
+    'Return the version identifier of the latest published SDE dump'
+    resp = requests.head(SDE_BASE_URL.format(SDE_VERSION_TABLE), timeout=30)
+    resp.raise_for_status()
+    return resp.headers.get('Last-Modified') or resp.headers['ETag']
+
+
+def import_sde(path: str = SDE_PATH) -> str:
+    '''Download the SDE dumps and build a fresh database at path.
+
+    Blocking, run it in an executor. Returns the imported version.'''
+    logger = get_logger(__name__)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    started = time.monotonic()
+    version = get_remote_version()
+    db = sqlite3.connect(str(tmp_path))
+    try:
+        db.executescript(SCHEMA)
+        for table, (dump, columns) in IMPORTS.items():
+            rows = _read_dump(dump, columns)
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                        table, ', '.join(name for name, _ in columns),
+                        ', '.join('?' * len(columns))), rows)
+            logger.info('Imported SDE table %s', table)
+
+        with db:
+            db.executemany('INSERT INTO meta (key, value) VALUES (?, ?)',
+                           [('version', version),
+                            ('schema_version', str(SCHEMA_VERSION)),
+                            ('imported_at', str(int(time.time())))])
+        db.execute('VACUUM')
+    finally:
+        db.close()
+
+    os.replace(str(tmp_path), str(path))
+    logger.info('Imported SDE version %s in %.1fs', version,
+                time.monotonic() - started)
+    return version
+
+
+def _read_dump(dump: str, columns) -> typing.Iterator[tuple]:
+    resp = requests.get(SDE_BASE_URL.format(dump), timeout=300)
+    resp.raise_for_status()
+    text = io.TextIOWrapper(bz2.BZ2File(io.BytesIO(resp.content)),
+                            encoding='utf-8')
+    for row in csv.DictReader(text):
+        yield tuple(_column(row, header) for _, header in columns)
+
+
+def _column(row: dict, header) -> typing.Any:
+    # A tuple of headers means "first non-empty one", e.g. for dogma values
+    # which are split between an integer and a float column.
+    if isinstance(header, tuple):
+        for candidate in header:
+            value = row.get(candidate)
+            if value not in (None, '', 'None'):
+                return value
+        return None
+    value = row[header]
+    return None if value == 'None' else value
@@ -0,0 +1,217 @@
+'''
+Central scheduler for outbound Discord requests.
+
+Every send goes through one queue per priority class and is only dispatched
+once the local token buckets for its route and the global limit allow it, so
+requests never pile up inside discord.py's rate limit handling. A class
+waiting on an exhausted bucket does not hold back other routes, and lower
+classes never take a token a higher class is waiting for.
+'''
+import asyncio
+import time
+import typing
+from collections import deque
+
+from utils.log import get_logger
+
+PING = 0
+OWNER_ALERT = 1
+KILLMAIL = 2
+REACTION = 3
+BACKFILL = 4
+PRIORITY_NAMES = ('pings', 'owner alerts', 'killmails', 'reactions',
+                  'backfill')
+
+# (requests, per seconds), matching the limits Discord documents per channel
+BUCKET_LIMITS = {
+    'messages': (5, 5.0),
+    'reactions': (1, 0.25),
+}
+GLOBAL_LIMIT = (50, 1.0)
+LATENCY_SAMPLES = 1000
+
+
+class TokenBucket:
+    'Allows `rate` requests every `per` seconds, refilling continuously'
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        'Seconds until a token is available'
+        self.tokens = min(self.rate, self.tokens +
+                          (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.per / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SendJob:
+    __slots__ = ('bucket', 'function', 'args', 'kwargs', 'future', 'queued')
+
+    def __init__(self, bucket, function, args, kwargs, future):
+        self.bucket = bucket
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.queued = time.monotonic()
+
+
+class SendScheduler:
+    '''Dispatches outbound requests by priority within rate limits
+
+    Callers await `submit`, which resolves to the result of the request.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.logger = get_logger(__name__)
+        self.loop = loop
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._buckets = {}
+        self._global = TokenBucket(*GLOBAL_LIMIT)
+        self._latencies = [deque(maxlen=LATENCY_SAMPLES)
+                           for _ in PRIORITY_NAMES]
+        self._sent = [0] * len(PRIORITY_NAMES)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def submit(self, priority: int, bucket: typing.Tuple[str, int],
+                     function: typing.Callable[..., typing.Awaitable],
+                     *args, **kwargs):
+        'Queue `function(*args, **kwargs)` and return its result once run'
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._dispatch_loop())
+
+        future = self.loop.create_future()
+        self._queues[priority].append(
+            SendJob(bucket, function, args, kwargs, future))
+        self._wakeup.set()
+        return await future
+
+    async def send_message(self, priority: int, channel, **kwargs):
+        'Send a message to channel, which may also be a user'
+        return await self.submit(priority, message_bucket(channel),
+                                 channel.send, **kwargs)
+
+    async def add_reaction(self, message, emoji, priority: int = REACTION):
+        return await self.submit(priority, reaction_bucket(message.channel),
+                                 message.add_reaction, emoji)
+
+    def get_stats(self) -> typing.Dict[str, dict]:
+        'Return sent, queued and queue latency percentiles per class'
+        stats = {}
+        for priority, name in enumerate(PRIORITY_NAMES):
+            latencies = sorted(self._latencies[priority])
+            stats[name] = {
+                'sent': self._sent[priority],
+                'queued': len(self._queues[priority]),
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'max': latencies[-1] if latencies else 0,
+            }
+        return stats
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        for queue in self._queues:
+            for job in queue:
+                job.future.cancel()
+            queue.clear()
+
+    def _get_bucket(self, key: typing.Tuple[str, int]) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*BUCKET_LIMITS[key[0]])
+        return bucket
+
+    async def _dispatch_loop(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self) -> typing.Optional[float]:
+        '''Start every job whose buckets have tokens, highest class first.
+        Returns the time until the next job could start, if any are left.'''
+        now = time.monotonic()
+        blocked = set()
+        delays = []
+        for priority, queue in enumerate(self._queues):
+            for job in list(queue):
+                if job.future.cancelled():
+                    queue.remove(job)
+                    continue
+                # Jobs on a route keep their order across classes
+                if job.bucket in blocked:
+                    continue
+
+                global_delay = self._global.delay(now)
+                if global_delay:
+                    return global_delay
+                bucket = self._get_bucket(job.bucket)
+                bucket_delay = bucket.delay(now)
+                if bucket_delay:
+                    blocked.add(job.bucket)
+                    delays.append(bucket_delay)
+                    continue
+
+                self._global.take()
+                bucket.take()
+                queue.remove(job)
+                self._latencies[priority].append(now - job.queued)
+                self._sent[priority] += 1
+                self._start(job)
+
+        return min(delays) if delays else None
+
+    def _start(self, job: SendJob):
+        task = self.loop.create_task(job.function(*job.args, **job.kwargs))
+
+        def done(task):
+            if job.future.cancelled():
+                return
+            if task.cancelled():
+                job.future.cancel()
+            elif task.exception() is not None:
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+        task.add_done_callback(done)
+
+
+def message_bucket(channel) -> typing.Tuple[str, int]:
+    return ('messages', channel.id)
+
+
+def reaction_bucket(channel) -> typing.Tuple[str, int]:
+    return ('reactions', channel.id)
+
+
+def percentile(values, fraction):
+    'Nearest-rank percentile of an already sorted list'
+    if not values:
+        return 0
+    rank = max(0, min(len(values) - 1, round(fraction * len(values)) - 1))
+    return values[rank]
+
+
+_scheduler: SendScheduler = None
+
+
+def get_send_scheduler(loop: asyncio.AbstractEventLoop) -> SendScheduler:
+    'Return the scheduler shared by every cog, creating it on first use'
+    global _scheduler  # pylint: disable=global-statement
+    if _scheduler is None:
+        _scheduler = SendScheduler(loop)
+    return _scheduler